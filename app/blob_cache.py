@@ -0,0 +1,174 @@
+"""
+Pull-through blob cache for sharing image layers between nodes.
+
+`python3 -m app.blob_cache` serves this node's LAYER_BLOB_PATH and the tags
+docker_pull recorded through the registry API of app.local_registry, so
+responses go out with sendfile(2) and honour Range requests. Other nodes
+list it in configs.PEER_MIRRORS and docker_pull tries it before the
+registry.
+
+On a miss the cache fetches the blob or tag from the upstream registry,
+checks it against its digest and keeps it. Concurrent requests for the same
+digest wait for that single upstream fetch, so rolling an image out to N
+nodes behind one cache costs one upstream download per layer, not N. A
+request that waits longer than BLOB_CACHE_WAIT gets a 504 and can retry.
+"""
+import re
+import sys
+import time
+import logging
+import argparse
+import threading
+from pathlib import Path
+from app import configs, tracing
+from app.local_registry import LocalRegistry
+
+log = logging.getLogger(__name__)
+
+DIGEST = re.compile(r"^sha256:[0-9a-f]{64}$")
+TAG = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9._-]{0,127}$")
+# Repository names as the distribution spec defines them, no empty or `..` components.
+REPO = re.compile(r"^[a-z0-9]+(?:(?:[._]|__|-+)[a-z0-9]+)*(?:/[a-z0-9]+(?:(?:[._]|__|-+)[a-z0-9]+)*)*$")
+
+
+def _image_name(repo: str) -> str:
+    """Maps `library/alpine` back to the name docker_pull stores the image under."""
+    namespace, _, name = repo.partition("/")
+    return name if namespace == configs.REGISTRY_NAMESPACE and name else repo
+
+
+class BlobCache(LocalRegistry):
+    """
+    Args:
+        blob_dir: Blobs to serve and to cache into, LAYER_BLOB_PATH by default.
+        image_dir: Where tags are looked up and recorded, LOCAL_IMAGE_REGISTRY
+                   by default.
+        upstream: Registry base URL misses are fetched from, None to only
+                  serve what is already on disk.
+        tag_ttl: Seconds a cached tag is served before it is resolved
+                 upstream again. Digests never go stale.
+        wait_timeout: Seconds a request waits for a concurrent request's
+                      upstream fetch of the same digest before it gets a 504.
+    """
+    def __init__(self, host: str = "0.0.0.0", port: int = configs.BLOB_CACHE_PORT, upstream: str = None,
+                 blob_dir=None, image_dir=None, tag_ttl: float = configs.BLOB_CACHE_TAG_TTL,
+                 verbose: bool = False, wait_timeout: float = configs.BLOB_CACHE_WAIT):
+        super().__init__(Path(blob_dir or configs.LAYER_BLOB_PATH), host, port, verbose=verbose)
+        self.image_dir = Path(image_dir or configs.LOCAL_IMAGE_REGISTRY)
+        self.upstream = upstream
+        self.tag_ttl = tag_ttl
+        self.wait_timeout = wait_timeout
+        self.upstream_fetches = 0
+        self._sessions = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _tag_file(self, repo: str, tag: str) -> Path:
+        return self.image_dir/_image_name(repo)/"tags"/tag
+
+    def _local(self, repo: str, kind: str, ref: str):
+        digest = ref
+        if kind == "manifests" and not DIGEST.match(ref):
+            tag_file = self._tag_file(repo, ref)
+            digest = tag_file.read_text().strip() if tag_file.exists() else None
+        if not digest or not DIGEST.match(digest):
+            return None
+        blob_path = self.root/digest
+        return (blob_path, digest) if blob_path.is_file() else None
+
+    def _stale(self, repo: str, tag: str) -> bool:
+        try:
+            return time.time() - self._tag_file(repo, tag).stat().st_mtime > self.tag_ttl
+        except FileNotFoundError:
+            return True
+
+    def lookup(self, repo: str, kind: str, ref: str, headers=None):
+        if not REPO.match(repo) or not (DIGEST.match(ref) or (kind == "manifests" and TAG.match(ref))):
+            return None
+        found = self._local(repo, kind, ref)
+        refresh = kind == "manifests" and not DIGEST.match(ref) and self._stale(repo, ref)
+        if self.upstream and (found is None or refresh):
+            # Digests are global, tags belong to a repository.
+            key = ref if DIGEST.match(ref) else f"{repo}:{ref}"
+            self._coalesced(key, lambda: self._fetch_upstream(repo, kind, ref))
+            found = self._local(repo, kind, ref)
+        return found
+
+    def _coalesced(self, key: str, fetch):
+        """
+        Runs `fetch` once for all threads asking for `key` at the same time.
+
+        Raises TimeoutError in the threads that waited longer than
+        wait_timeout for it.
+        """
+        with self._lock:
+            done = self._inflight.get(key)
+            leader = done is None
+            if leader:
+                done = self._inflight[key] = threading.Event()
+        if not leader:
+            tracing.count("blob_cache.coalesced")
+            if not done.wait(self.wait_timeout):
+                raise TimeoutError(f"Upstream fetch of {key} is still running after {self.wait_timeout}s")
+            return
+        try:
+            fetch()
+        except Exception as e:
+            log.warning("Upstream fetch of %s failed: %s", key, e)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            done.set()
+
+    def _session(self, repo: str):
+        from app.pull import UpstreamSession
+        with self._lock:
+            session = self._sessions.get(repo)
+            if session is None:
+                session = self._sessions[repo] = UpstreamSession(_image_name(repo), self.upstream)
+            return session
+
+    def _fetch_upstream(self, repo: str, kind: str, ref: str):
+        from app import pull
+        session = self._session(repo)
+        with self._lock:
+            self.upstream_fetches += 1
+        with tracing.span("blob_cache.fetch_upstream", kind=kind, ref=ref):
+            if kind == "blobs":
+                pull.fetch_blob(session, ref, blob_dir=self.root)
+                return
+            digest = pull.cache_blob(pull.fetch_manifest(session, ref), self.root)
+            if DIGEST.match(ref):
+                if digest != ref:
+                    (self.root/digest).unlink(missing_ok=True)
+                    raise ValueError(f"Manifest from {self.upstream} does not match {ref}")
+            else:
+                pull.save_tag(_image_name(repo), ref, digest, self.image_dir)
+        log.info("Cached %s %s from %s", kind, ref, self.upstream)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pull-through blob cache for peer nodes")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=configs.BLOB_CACHE_PORT)
+    parser.add_argument("--upstream", default=configs.REGISTRY_URL, help="Registry base URL misses are fetched from")
+    parser.add_argument("--no-upstream", action="store_true", help="Only serve blobs already on this node")
+    parser.add_argument("--blob-dir", default=configs.LAYER_BLOB_PATH)
+    parser.add_argument("--image-dir", default=configs.LOCAL_IMAGE_REGISTRY)
+    parser.add_argument("--tag-ttl", type=float, default=configs.BLOB_CACHE_TAG_TTL)
+    parser.add_argument("--wait-timeout", type=float, default=configs.BLOB_CACHE_WAIT,
+                        help="Seconds to wait for a concurrent upstream fetch before answering 504")
+    args = parser.parse_args(argv)
+
+    cache = BlobCache(args.host, args.port, None if args.no_upstream else args.upstream,
+                      args.blob_dir, args.image_dir, args.tag_ttl, verbose=True, wait_timeout=args.wait_timeout)
+    print(f"[+] Serving {cache.root} at {cache.url}", file=sys.stderr)
+    try:
+        cache.serve_forever()
+    except KeyboardInterrupt:
+        cache.server_close()
+
+
+if __name__ == "__main__":
+    tracing.configure_logging()
+    main()
@@ -0,0 +1,56 @@
+import os
+import uuid
+import logging
+from pathlib import Path
+from contextlib import contextmanager
+from app.configs import CGROUP_PATH, MEM_UNIT_MAP
+
+log = logging.getLogger(__name__)
+
+
+@contextmanager
+def manage_cgroup(image_name: str, mem_limit: str, cpu_percent: int):
+    """
+    A context manager to create, configure, and clean up a cgroup for a container.
+
+    Yields:
+        The Path object for the created cgroup directory.
+    """
+    # 1. SETUP: Create a unique cgroup directory
+    cgroup_base = Path(CGROUP_PATH) / "mydocker"
+    cgroup_base.mkdir(exist_ok=True)
+    
+    container_id = f"{image_name.replace(':', '_')}_{uuid.uuid4().hex[:8]}"
+    cgroup_path = cgroup_base / container_id
+    cgroup_path.mkdir()
+
+    try:
+        (cgroup_base / "cgroup.subtree_control").write_text("+cpu +memory")
+    except OSError as e:
+        log.warning("We got an error while creating cgroup.subtree_control: %s. We are ignoring it", e)
+        pass
+
+
+    try:
+
+        if mem_limit:
+            amount = "".join(c for c in mem_limit.lower() if c.isdigit())
+            unit = "".join(c for c in mem_limit.lower() if not c.isdigit())
+            try:
+                amount_in_bytes = int(amount) * MEM_UNIT_MAP[unit]
+                (cgroup_path / "memory.max").write_text(str(amount_in_bytes))
+            except (KeyError, ValueError) as e:
+                log.error("Invalid memory limit format: %s. Error: %s", mem_limit, e)
+        
+        if cpu_percent:
+            max_us = int(cpu_percent * 1000)
+            quota_us = 100000
+            (cgroup_path / "cpu.max").write_text(f"{max_us} {quota_us}")
+
+        yield cgroup_path
+
+    finally:
+        try:
+            os.rmdir(cgroup_path)
+        except OSError as e:
+            log.error("Error cleaning up cgroup %s: %s", cgroup_path, e)
@@ -7,4 +7,27 @@ DEFAULT_BRIDGE_NAME = "puncker0"
 CONTAINER_RUNTIME_ROOT_DIR="/home/kalish/Documents/projects/LEARNING/building-docker/codecrafters-docker-python/runtimes"
 LAYER_BLOB_PATH="/home/kalish/Documents/projects/LEARNING/building-docker/codecrafters-docker-python/layer_blobs"
 EXTRACTED_LAYERS_PATH="/home/kalish/Documents/projects/LEARNING/building-docker/codecrafters-docker-python/extracted_layers"
-DNS_FILE_PATH="/etc/resolv.conf"
\ No newline at end of file
+DNS_FILE_PATH="/etc/resolv.conf"
+CONTAINER_LOG_PATH="/home/kalish/Documents/projects/LEARNING/building-docker/codecrafters-docker-python/container_logs"
+LOG_MAX_BYTES = 10 * 1024**2 # Rotate a container log once it grows past this size
+LOG_MAX_FILES = 3 # Log files kept per container, the live one included
+LOG_PIPE_SIZE = 1024**2 # Kernel pipe buffer for container stdout/stderr
+LOG_TAIL_BUFFER = 1024**2 # Upper bound on bytes held in memory for `logs --tail`
+REGISTRY_URL = "https://registry-1.docker.io" # Base URL of the image registry, without the /v2 suffix
+REGISTRY_NAMESPACE = "library" # Repository namespace images are looked up under
+PULL_CONCURRENCY = 4 # Layers downloaded and extracted in parallel by docker_pull
+CONTAINER_STATE_PATH="/home/kalish/Documents/projects/LEARNING/building-docker/codecrafters-docker-python/containers"
+LAYER_DEDUP = "off" # File-level dedup of extracted layers: "off", "hardlink" or "reflink"
+CONTENT_STORE_PATH="/home/kalish/Documents/projects/LEARNING/building-docker/codecrafters-docker-python/content_store" # Must share a filesystem with EXTRACTED_LAYERS_PATH
+DEDUP_MIN_SIZE = 1024 # Files smaller than this are extracted as they are
+PEER_MIRRORS = [] # Base URLs of peer blob caches docker_pull tries before the registry, e.g. "http://10.0.0.2:5050"
+MIRROR_TIMEOUT = 5 # Seconds to connect to a peer mirror before it is skipped
+UPSTREAM_TIMEOUT = 30 # Seconds the registry may stay silent (connect or between reads) before a request fails
+BLOB_CACHE_PORT = 5050 # Port `python3 -m app.blob_cache` listens on
+BLOB_CACHE_TAG_TTL = 300 # Seconds a pull-through cache serves a tag before asking the registry again
+BLOB_CACHE_WAIT = 300 # Seconds a request waits for another request's upstream fetch before getting a 504
+CONTAINER_STORAGE = "disk" # Where the overlay upperdir lives: "disk" (under CONTAINER_RUNTIME_ROOT_DIR) or "tmpfs"
+CONTAINER_MEMORY_LIMIT = "500MB" # memory.max of a container's cgroup
+TMPFS_ROOTFS_SIZE = "256MB" # Size cap of a tmpfs upperdir, below CONTAINER_MEMORY_LIMIT so a full one reports ENOSPC instead of OOM
+TMPFS_SCRATCH_SIZE = "64MB" # Size cap of a `--tmpfs` scratch mount or a tmpfs volume without an explicit size
+VOLUMES_PATH="/home/kalish/Documents/projects/LEARNING/building-docker/codecrafters-docker-python/volumes"
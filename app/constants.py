@@ -13,6 +13,8 @@ class CommonFlags:
     MS_REC: int = 0x4000 # Recursive mounts
     MS_PRIVATE: int = 0x40000 # Mount private
     MS_BIND: int = 0x1000 # Bind mount
+    MS_NOSUID: int = 0x2 # Ignore suid/sgid bits
+    MS_NODEV: int = 0x4 # No device files
 
 
 COMMON_LIBC_FLAGS = CommonFlags()
\ No newline at end of file
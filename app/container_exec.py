@@ -0,0 +1,222 @@
+"""
+Running extra processes inside a running container (`exec`).
+
+The caller joins the container's namespaces with setns(2), through a pidfd
+where the kernel supports it (5.8+) or through /proc/<pid>/ns/* otherwise,
+moves itself into the container's cgroup and posix_spawn()s the command.
+Joining a PID namespace only applies to children, posix_spawn gives us that
+child without copying the Python process the way os.fork() would.
+
+Opened handles are kept in a NamespaceCache so a long-lived caller (health
+checks every second across many containers) pays for the /proc lookups once
+per container rather than once per exec.
+"""
+import os
+import sys
+import errno
+import select
+import logging
+from pathlib import Path
+from app import libc, state, tracing
+from app.constants import COMMON_LIBC_FLAGS as uflags
+
+log = logging.getLogger(__name__)
+
+# Joined in this order when falling back to /proc ns files: the user
+# namespace first so we hold capabilities in the others.
+NAMESPACES = [
+    ("user", uflags.CLONE_NEWUSER),
+    ("ipc", uflags.CLONE_NEWIPC),
+    ("uts", uflags.CLONE_NEWUTS),
+    ("net", uflags.CLONE_NEWNET),
+    ("cgroup", uflags.CLONE_NEWCGROUP),
+    ("mnt", uflags.CLONE_NEWNS),
+]
+DEFAULT_ENV = {
+    "PATH": "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin",
+    "HOME": "/root",
+}
+
+
+def _same_namespace(pid: int, ns: str, own: str = None) -> bool:
+    return os.stat(f"/proc/{pid}/ns/{ns}").st_ino == os.stat(f"/proc/self/ns/{own or ns}").st_ino
+
+
+class ContainerHandle:
+    """
+    Open references to one container's namespaces and cgroup.
+
+    The container's supervised child is not in the container's PID namespace
+    itself (unshare(CLONE_NEWPID) only applies to its children), so the PID
+    namespace is taken from its pid_for_children link.
+
+    Args:
+        start_time: The pid's start time recorded at registration. A pid
+                    that has been reused by another process is refused.
+    """
+    def __init__(self, container_id: str, pid: int, cgroup_path=None, start_time: int = None):
+        self.container_id = container_id
+        self.pid = pid
+        self._pidfd = None
+        self._pidfd_flags = 0
+        self._ns_fds = [] # (fd, flag) joined one by one
+        self._cgroup_fd = None
+
+        try:
+            self._pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            pass
+
+        try:
+            if start_time is not None and state.process_start_time(pid) != start_time:
+                raise FileNotFoundError(pid)
+            if _same_namespace(pid, "user") or _same_namespace(pid, "mnt"):
+                # Whatever this is, it is not a container: exec would run on the host.
+                self.close()
+                raise PermissionError(errno.EPERM, f"Container {container_id} (pid {pid}) shares our "
+                                                   "user or mount namespace, refusing to exec")
+            wanted = [(name, flag) for name, flag in NAMESPACES if not _same_namespace(pid, name)]
+            if self._pidfd is not None:
+                self._pidfd_flags = 0
+                for _, flag in wanted:
+                    self._pidfd_flags |= flag
+            else:
+                self._open_ns_files(wanted)
+            if not _same_namespace(pid, "pid_for_children", "pid"):
+                fd = os.open(f"/proc/{pid}/ns/pid_for_children", os.O_RDONLY | os.O_CLOEXEC)
+                self._ns_fds.append((fd, uflags.CLONE_NEWPID))
+            if cgroup_path:
+                self._cgroup_fd = os.open(Path(cgroup_path)/"cgroup.procs", os.O_WRONLY | os.O_CLOEXEC)
+            if start_time is not None and state.process_start_time(pid) != start_time:
+                # The /proc files above could belong to a process that reused the pid meanwhile.
+                raise FileNotFoundError(pid)
+        except FileNotFoundError:
+            self.close()
+            raise ProcessLookupError(errno.ESRCH, f"Container {container_id} (pid {pid}) is not running")
+
+    def _open_ns_files(self, wanted: list):
+        # Namespace fds go before the PID one, user first.
+        self._ns_fds[:0] = [(os.open(f"/proc/{self.pid}/ns/{name}", os.O_RDONLY | os.O_CLOEXEC), flag)
+                            for name, flag in wanted]
+
+    def alive(self) -> bool:
+        if self._pidfd is not None:
+            # A pidfd turns readable once the process has exited.
+            return not select.select([self._pidfd], [], [], 0)[0]
+        return os.path.exists(f"/proc/{self.pid}")
+
+    def enter(self):
+        """
+        Moves the calling process into the container's cgroup and namespaces.
+
+        The caller must be single threaded (a user namespace cannot be joined
+        otherwise) and will not be able to leave again.
+        """
+        if self._cgroup_fd is not None:
+            os.write(self._cgroup_fd, b"0") # "0" moves the writing process itself
+        if self._pidfd is not None and self._pidfd_flags:
+            try:
+                libc.setns(self._pidfd, self._pidfd_flags)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                # Kernel without setns() on pidfds, use the /proc files.
+                wanted = [(name, flag) for name, flag in NAMESPACES if flag & self._pidfd_flags]
+                self._open_ns_files(wanted)
+                self._pidfd_flags = 0
+        for fd, flag in self._ns_fds:
+            libc.setns(fd, flag)
+        # setns(CLONE_NEWNS) already reset our root and cwd to the container's.
+        os.chdir("/")
+
+    def close(self):
+        fds = [fd for fd, _ in self._ns_fds] + [self._pidfd, self._cgroup_fd]
+        for fd in fds:
+            if fd is not None:
+                os.close(fd)
+        self._ns_fds, self._pidfd, self._cgroup_fd = [], None, None
+
+
+class NamespaceCache:
+    """Keeps one ContainerHandle per container until its process goes away."""
+    def __init__(self):
+        self._handles = {}
+
+    def get(self, name: str) -> ContainerHandle:
+        handle = self._handles.get(name)
+        if handle is not None:
+            if handle.alive():
+                return handle
+            handle.close()
+            del self._handles[name]
+
+        info = state.load_container(name)
+        handle = ContainerHandle(info["id"], info["pid"], info.get("cgroup"), info.get("pid_start_time"))
+        self._handles[name] = handle
+        return handle
+
+    def close(self):
+        for handle in self._handles.values():
+            handle.close()
+        self._handles.clear()
+
+
+def _spawn_inside(handle: ContainerHandle, argv: list, env: dict) -> int:
+    """Enters `handle` and runs argv there. Returns the command's exit code."""
+    handle.enter()
+    os.setgid(0)
+    os.setuid(0)
+    os.environ.clear()
+    os.environ.update(env)
+    pid = os.posix_spawnp(argv[0], argv, env)
+    _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+@tracing.traced("container_exec.exec_in_container")
+def exec_in_container(name: str, argv: list, cache: NamespaceCache = None, env: dict = None) -> int:
+    """
+    Runs `argv` inside a running container and returns its exit code.
+
+    The caller's own namespaces are left alone: joining a user namespace
+    cannot be undone and needs a single threaded process, so this forks the
+    calling interpreter (copy-on-write) and the fork calls setns and
+    posix_spawn. CLI use that can give up its own process should call
+    exec_here() instead, which does not fork Python at all.
+    """
+    env = {**DEFAULT_ENV, "TERM": os.environ.get("TERM", "xterm"), **(env or {})}
+    handle = (cache or NamespaceCache()).get(name)
+    pid = os.fork()
+    if pid == 0:
+        code = 127
+        try:
+            code = _spawn_inside(handle, argv, env)
+        except BaseException as e:
+            log.error("exec in %s failed: %s", name, e)
+        finally:
+            os._exit(code)
+    if cache is None:
+        handle.close()
+    _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+
+def exec_here(name: str, argv: list, env: dict = None) -> int:
+    """Moves this process into the container and runs argv there, no fork."""
+    env = {**DEFAULT_ENV, "TERM": os.environ.get("TERM", "xterm"), **(env or {})}
+    handle = NamespaceCache().get(name)
+    return _spawn_inside(handle, argv, env)
+
+
+def main(argv: list):
+    """Entry point for `exec <container> <command> [args...]`."""
+    if len(argv) < 2:
+        print("Usage: exec <container> <command> [args...]", file=sys.stderr)
+        sys.exit(1)
+    try:
+        code = exec_here(argv[0], argv[1:])
+    except (LookupError, ProcessLookupError, PermissionError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    tracing.flush()
+    sys.exit(code)
@@ -0,0 +1,349 @@
+import os
+import sys
+import time
+import errno
+import fcntl
+import argparse
+import selectors
+from pathlib import Path
+from app import configs
+
+
+LOG_FILE_NAME = "container.log"
+EXITED_MARKER = "exited"
+
+
+def container_log_dir(container_id: str) -> Path:
+    safe_id = container_id.replace(':', '_').replace('/', '_')
+    return Path(configs.CONTAINER_LOG_PATH)/safe_id
+
+
+def _copy_range(out_fd: int, in_fd: int, offset: int, count: int):
+    """
+    Copies `count` bytes starting at `offset` of `in_fd` to `out_fd`.
+
+    Uses sendfile so the data goes straight from the page cache to the
+    destination. Falls back to pread/write when the destination does not
+    support sendfile.
+    """
+    while count > 0:
+        try:
+            sent = os.sendfile(out_fd, in_fd, offset, count)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            data = os.pread(in_fd, count, offset)
+            if not data:
+                return
+            sent = os.write(out_fd, data)
+        if sent == 0:
+            return
+        offset += sent
+        count -= sent
+
+
+class LogRingBuffer:
+    """
+    A fixed-capacity byte ring. Writing past the capacity overwrites the oldest
+    bytes, so memory use never exceeds `capacity` no matter how much is fed in.
+    """
+    def __init__(self, capacity: int = configs.LOG_TAIL_BUFFER):
+        self.capacity = capacity
+        self._buf = bytearray(capacity)
+        self._end = 0 # Next write position
+        self._size = 0
+
+    def write(self, data: bytes):
+        if len(data) >= self.capacity:
+            self._buf[:] = data[-self.capacity:]
+            self._end = 0
+            self._size = self.capacity
+            return
+        first = min(len(data), self.capacity - self._end)
+        self._buf[self._end:self._end + first] = data[:first]
+        self._buf[:len(data) - first] = data[first:]
+        self._end = (self._end + len(data)) % self.capacity
+        self._size = min(self.capacity, self._size + len(data))
+
+    def getvalue(self) -> bytes:
+        start = (self._end - self._size) % self.capacity
+        if start + self._size <= self.capacity:
+            return bytes(self._buf[start:start + self._size])
+        return bytes(self._buf[start:] + self._buf[:self._end])
+
+    def lines(self, count: int) -> list:
+        """Returns the last `count` lines held in the ring."""
+        if count <= 0:
+            return []
+        data = self.getvalue()
+        if self._size == self.capacity and b"\n" in data:
+            # The first line was probably cut in half by the ring, drop it.
+            data = data[data.index(b"\n") + 1:]
+        return data.splitlines(keepends=True)[-count:]
+
+
+class ContainerLogger:
+    """
+    Moves a container's stdout/stderr into a size-rotated log file.
+
+    The container writes into pipes and the supervisor splices the pipe pages
+    into the log file, so the output never passes through a Python buffer.
+    A container that writes faster than the disk blocks on its full pipe
+    instead of growing the supervisor's memory.
+    """
+    def __init__(self, container_id: str, max_bytes: int = configs.LOG_MAX_BYTES,
+                 max_files: int = configs.LOG_MAX_FILES, chunk_size: int = configs.LOG_PIPE_SIZE):
+        self.container_id = container_id
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.chunk_size = chunk_size
+        self.log_dir = container_log_dir(container_id)
+        self.log_path = self.log_dir/LOG_FILE_NAME
+        # time.monotonic() of the first byte the container wrote, if any.
+        self.first_output_at = None
+
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        (self.log_dir/EXITED_MARKER).unlink(missing_ok=True)
+        self._open_log()
+
+        self.stdout_r, self.stdout_w = os.pipe()
+        self.stderr_r, self.stderr_w = os.pipe()
+        for fd in (self.stdout_w, self.stderr_w):
+            try:
+                fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, configs.LOG_PIPE_SIZE)
+            except OSError:
+                # Above /proc/sys/fs/pipe-max-size for unprivileged users, keep the default.
+                pass
+
+    def _open_log(self):
+        self._log_fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o640)
+        # Continue after whatever an earlier run of this container already wrote.
+        self._offset = os.fstat(self._log_fd).st_size
+
+    def _rotate(self):
+        os.close(self._log_fd)
+        for i in range(self.max_files - 1, 0, -1):
+            older = self.log_dir/f"{LOG_FILE_NAME}.{i}"
+            if older.exists():
+                os.replace(older, self.log_dir/f"{LOG_FILE_NAME}.{i + 1}")
+        os.replace(self.log_path, self.log_dir/f"{LOG_FILE_NAME}.1")
+        (self.log_dir/f"{LOG_FILE_NAME}.{self.max_files}").unlink(missing_ok=True)
+        self._open_log()
+
+    def redirect_child(self):
+        """Called in the child after fork: points fd 1 and 2 at the log pipes."""
+        os.dup2(self.stdout_w, 1)
+        os.dup2(self.stderr_w, 2)
+        self.close_all()
+
+    def close_all(self):
+        """Called in forked processes that neither write the container's output nor pump it."""
+        for fd in (self.stdout_r, self.stdout_w, self.stderr_r, self.stderr_w, self._log_fd):
+            os.close(fd)
+
+    def close_child_ends(self):
+        """Called in the parent after fork so the pipes see EOF when the container exits."""
+        os.close(self.stdout_w)
+        os.close(self.stderr_w)
+
+    def _move(self, src_fd: int, mirror_fd: int = None) -> int:
+        """
+        Moves whatever is waiting in `src_fd` into the log file.
+
+        Returns the number of bytes moved, 0 on EOF, or -1 if the pipe was empty.
+        """
+        offset = self._offset
+        try:
+            moved = os.splice(src_fd, self._log_fd, self.chunk_size, offset_dst=offset,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return -1
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            # The log file lives on a filesystem without splice support.
+            try:
+                data = os.read(src_fd, self.chunk_size)
+            except BlockingIOError:
+                return -1
+            moved = os.pwrite(self._log_fd, data, offset) if data else 0
+
+        if moved > 0:
+            if self.first_output_at is None:
+                self.first_output_at = time.monotonic()
+            self._offset += moved
+            if mirror_fd is not None:
+                _copy_range(mirror_fd, self._log_fd, offset, moved)
+            if self._offset >= self.max_bytes:
+                self._rotate()
+        return moved
+
+    def pump(self, mirror: bool = False):
+        """
+        Drains both pipes into the log file until the container closes them.
+
+        Args:
+            mirror: Also echo the output to this process's stdout/stderr, as a
+                    foreground `run` does.
+        """
+        mirrors = {self.stdout_r: 1, self.stderr_r: 2} if mirror else {}
+        sel = selectors.DefaultSelector()
+        for fd in (self.stdout_r, self.stderr_r):
+            os.set_blocking(fd, False)
+            sel.register(fd, selectors.EVENT_READ)
+
+        try:
+            while sel.get_map():
+                for key, _ in sel.select():
+                    if self._move(key.fd, mirrors.get(key.fd)) == 0:
+                        sel.unregister(key.fd)
+                        os.close(key.fd)
+        finally:
+            sel.close()
+            os.close(self._log_fd)
+            (self.log_dir/EXITED_MARKER).touch()
+
+
+def _log_files_oldest_first(log_dir: Path) -> list:
+    rotated = sorted(log_dir.glob(f"{LOG_FILE_NAME}.*"), key=lambda p: int(p.suffix[1:]), reverse=True)
+    current = log_dir/LOG_FILE_NAME
+    return rotated + ([current] if current.exists() else [])
+
+
+def _open_rotated_after(log_dir: Path, ino: int) -> list:
+    """
+    Opens the rotated files written after the one with inode `ino`, oldest first.
+
+    When that file has already been rotated away, every rotated file is newer.
+    """
+    fds = []
+    rotated = sorted(log_dir.glob(f"{LOG_FILE_NAME}.*"), key=lambda p: int(p.suffix[1:]))
+    for path in rotated: # newest first
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        except FileNotFoundError:
+            continue
+        if os.fstat(fd).st_ino == ino:
+            os.close(fd)
+            break
+        fds.append(fd)
+    return fds[::-1]
+
+
+def tail_log(container_id: str, lines: int, buffer_size: int = configs.LOG_TAIL_BUFFER) -> list:
+    """
+    Returns the last `lines` lines logged by a container.
+
+    Only the last `buffer_size` bytes of each log file are read, into a ring
+    of that size, so tailing a huge log costs a bounded amount of memory.
+    """
+    log_dir = container_log_dir(container_id)
+    if not log_dir.exists():
+        raise FileNotFoundError(f"No logs found for container {container_id}")
+
+    ring = LogRingBuffer(buffer_size)
+    for path in _log_files_oldest_first(log_dir):
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            size = os.fstat(fd).st_size
+            offset = max(0, size - buffer_size)
+            while offset < size:
+                data = os.pread(fd, min(size - offset, 1024 * 1024), offset)
+                if not data:
+                    break
+                ring.write(data)
+                offset += len(data)
+        finally:
+            os.close(fd)
+    return ring.lines(lines)
+
+
+def follow_log(container_id: str, out_fd: int = 1, from_offset: int = None, poll_interval: float = 0.2):
+    """
+    Streams a container's log to `out_fd` as it grows, like `tail -f`.
+
+    Follows the log across rotations, including several between two polls,
+    and returns once the container has exited and everything it wrote has
+    been sent.
+
+    Args:
+        from_offset: Where to start in the current log file. Defaults to its end.
+    """
+    log_dir = container_log_dir(container_id)
+    log_path = log_dir/LOG_FILE_NAME
+    fd = os.open(log_path, os.O_RDONLY | os.O_CLOEXEC)
+    pos = os.fstat(fd).st_size if from_offset is None else from_offset
+    try:
+        while True:
+            exited = (log_dir/EXITED_MARKER).exists()
+            size = os.fstat(fd).st_size
+            if size > pos:
+                _copy_range(out_fd, fd, pos, size - pos)
+                pos = size
+                continue
+
+            try:
+                rotated = os.stat(log_path).st_ino != os.fstat(fd).st_ino
+            except FileNotFoundError:
+                rotated = False # Mid-rotation, the new file is not there yet
+            if rotated:
+                # Drain what landed in the old file between our last read and the rotation.
+                size = os.fstat(fd).st_size
+                if size > pos:
+                    _copy_range(out_fd, fd, pos, size - pos)
+                # Files that were filled and rotated away since then.
+                for newer_fd in _open_rotated_after(log_dir, os.fstat(fd).st_ino):
+                    try:
+                        _copy_range(out_fd, newer_fd, 0, os.fstat(newer_fd).st_size)
+                    finally:
+                        os.close(newer_fd)
+                os.close(fd)
+                fd = os.open(log_path, os.O_RDONLY | os.O_CLOEXEC)
+                pos = 0
+                continue
+
+            if exited:
+                return
+            time.sleep(poll_interval)
+    finally:
+        os.close(fd)
+
+
+def main(argv: list):
+    """Entry point for `logs [-f] [--tail N] <container_id>`."""
+    parser = argparse.ArgumentParser(prog="logs", description="Show a container's output")
+    parser.add_argument("-f", "--follow", action="store_true")
+    parser.add_argument("-n", "--tail", type=int)
+    parser.add_argument("container_id")
+    args = parser.parse_args(argv)
+
+    log_dir = container_log_dir(args.container_id)
+    if not log_dir.exists():
+        print(f"Error: No logs found for container {args.container_id}", file=sys.stderr)
+        sys.exit(1)
+    log_path = log_dir/LOG_FILE_NAME
+
+    if args.tail is not None:
+        for line in tail_log(args.container_id, args.tail):
+            sys.stdout.buffer.write(line)
+        sys.stdout.flush()
+        start = log_path.stat().st_size if log_path.exists() else 0
+    else:
+        # Everything the container logged, oldest rotated file first. When
+        # following, the current file is left to follow_log.
+        files = _log_files_oldest_first(log_dir)
+        if args.follow:
+            files = [path for path in files if path != log_path]
+        for path in files:
+            fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+            try:
+                _copy_range(sys.stdout.fileno(), fd, 0, os.fstat(fd).st_size)
+            finally:
+                os.close(fd)
+        start = 0
+
+    if args.follow:
+        try:
+            follow_log(args.container_id, sys.stdout.fileno(), from_offset=start)
+        except KeyboardInterrupt:
+            pass
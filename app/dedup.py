@@ -0,0 +1,228 @@
+"""
+Content-addressed file store for extracted layers.
+
+With configs.LAYER_DEDUP enabled, every regular file in a layer is hashed as
+it comes out of the tar stream. The first copy of a given content lands in
+CONTENT_STORE_PATH, and every later copy becomes a hardlink to it (or a
+reflink, on filesystems that support FICLONE). Hardlinked files share one
+inode, so containers built from different images also share page cache for
+libc, locales, CA bundles and the like.
+
+The store key includes mode and ownership as well as the content hash,
+because hardlinks share metadata. Overlayfs copies a lower file up before
+modifying it, so containers never write through to the shared copy.
+"""
+import os
+import sys
+import fcntl
+import errno
+import shutil
+import hashlib
+import logging
+import tarfile
+import tempfile
+from pathlib import Path
+from app import configs, tracing
+
+log = logging.getLogger(__name__)
+
+FICLONE = 0x40049409 # _IOW(0x94, 9, int)
+CHUNK_SIZE = 1024 * 1024
+
+
+class DedupStats:
+    def __init__(self):
+        self.files = 0
+        self.deduped = 0
+        self.bytes = 0
+        self.bytes_saved = 0
+
+    def as_dict(self) -> dict:
+        return {"files": self.files, "deduped": self.deduped,
+                "bytes": self.bytes, "bytes_saved": self.bytes_saved}
+
+
+class ContentStore:
+    """
+    Args:
+        mode: "hardlink" or "reflink". Reflinks fall back to hardlinks where
+              the filesystem cannot clone.
+    """
+    def __init__(self, root=None, mode: str = None):
+        self.root = Path(root or configs.CONTENT_STORE_PATH)
+        self.mode = mode or configs.LAYER_DEDUP
+        if self.mode not in ("hardlink", "reflink"):
+            raise ValueError(f"Unknown dedup mode: {self.mode}")
+        self.objects = self.root/"objects"
+        self.tmp = self.root/"tmp"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.tmp.mkdir(parents=True, exist_ok=True)
+
+    def _object_path(self, digest: str, member: tarfile.TarInfo) -> Path:
+        key = f"{digest}-{member.mode & 0o7777:o}-{member.uid}-{member.gid}"
+        return self.objects/digest[:2]/key
+
+    def _stage(self, tar: tarfile.TarFile, member: tarfile.TarInfo) -> tuple:
+        """Streams a member into the store's tmp dir. Returns (tmp path, sha256)."""
+        sha = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp)
+        with os.fdopen(fd, "wb") as out, tar.extractfile(member) as src:
+            while chunk := src.read(CHUNK_SIZE):
+                sha.update(chunk)
+                out.write(chunk)
+        return Path(tmp_path), sha.hexdigest()
+
+    def _apply_metadata(self, path: Path, member: tarfile.TarInfo):
+        if os.geteuid() == 0:
+            os.chown(path, member.uid, member.gid)
+        os.chmod(path, member.mode & 0o7777)
+        os.utime(path, (member.mtime, member.mtime))
+
+    def _reflink(self, src: Path, dest: Path, member: tarfile.TarInfo) -> bool:
+        dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600)
+        try:
+            with open(src, "rb") as s:
+                fcntl.ioctl(dest_fd, FICLONE, s.fileno())
+        except OSError as e:
+            os.close(dest_fd)
+            os.unlink(dest)
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL):
+                return False
+            raise
+        os.close(dest_fd)
+        self._apply_metadata(dest, member)
+        return True
+
+    def add(self, tar: tarfile.TarFile, member: tarfile.TarInfo, dest: Path) -> bool:
+        """
+        Extracts a regular file member to `dest` through the store.
+
+        Returns True when the content was already in the store.
+        """
+        tmp_path, digest = self._stage(tar, member)
+        obj = self._object_path(digest, member)
+        obj.parent.mkdir(exist_ok=True)
+        try:
+            self._apply_metadata(tmp_path, member)
+            # link() is atomic, two layers extracting the same file at once cannot both win.
+            os.link(tmp_path, obj)
+            known = False
+        except FileExistsError:
+            known = True
+        finally:
+            os.unlink(tmp_path)
+
+        if dest.exists() or dest.is_symlink():
+            dest.unlink()
+        if self.mode == "reflink" and self._reflink(obj, dest, member):
+            return known
+        try:
+            os.link(obj, dest)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EMLINK):
+                raise
+            # Store on another filesystem or inode out of links, keep a private copy.
+            shutil.copy2(obj, dest)
+        return known
+
+    def stats(self) -> dict:
+        """
+        Store-wide numbers from the link counts of the stored objects.
+
+        Reflinked copies have their own inodes and do not show up here.
+        """
+        objects, references, stored, saved = 0, 0, 0, 0
+        for path in self.objects.glob("*/*"):
+            st = path.stat()
+            links = st.st_nlink - 1 # the store's own entry
+            objects += 1
+            references += links
+            stored += st.st_size
+            saved += st.st_size * max(0, links - 1)
+        return {"objects": objects, "references": references,
+                "bytes_stored": stored, "bytes_saved": saved}
+
+
+def _safe_target(dest_path: Path, name: str) -> Path:
+    """Refuses members that would land outside the layer dir, through '..' or a symlinked parent."""
+    target = dest_path/name.lstrip("/")
+    root = os.path.realpath(dest_path)
+    parent = os.path.realpath(target.parent)
+    if ".." in Path(name).parts or os.path.commonpath([root, parent]) != root:
+        raise ValueError(f"Layer member escapes the extraction dir: {name}")
+    return target
+
+
+def _replace_target(target: Path):
+    """
+    Unlinks whatever non-directory is at `target`.
+
+    tarfile writes into an existing file in place (and falls back to copying
+    a hardlink's data into it), which would truncate a store object shared
+    with every other layer linked to it.
+    """
+    if target.is_symlink() or (target.exists() and not target.is_dir()):
+        target.unlink()
+
+
+@tracing.traced("dedup.extract_layer")
+def extract_layer(layer_path, dest_path, store: ContentStore = None) -> dict:
+    """
+    Extracts a layer like pull.extract_layer, deduplicating regular files.
+
+    Safe to run again over a partly or fully extracted layer: existing
+    entries are replaced, never written through.
+
+    Returns the DedupStats of this layer as a dict.
+    """
+    store = store or ContentStore()
+    dest_path = Path(dest_path)
+    dest_path.mkdir(parents=True, exist_ok=True)
+    stats = DedupStats()
+    with tarfile.open(layer_path, mode="r:*") as tar:
+        directories = []
+        for member in tar:
+            target = _safe_target(dest_path, member.name)
+            if member.isdir():
+                directories.append(member)
+                tar.extract(member, dest_path, set_attrs=False)
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            _replace_target(target)
+            if member.islnk():
+                # Link to the file this layer already extracted, which may be a store object.
+                os.link(_safe_target(dest_path, member.linkname), target)
+                continue
+            if not member.isreg() or member.size < configs.DEDUP_MIN_SIZE:
+                tar.extract(member, dest_path)
+                continue
+            stats.files += 1
+            stats.bytes += member.size
+            if store.add(tar, member, target):
+                stats.deduped += 1
+                stats.bytes_saved += member.size
+        # Directory attributes last, the way extractall() does it.
+        for member in reversed(directories):
+            tar.extract(member, dest_path)
+
+    log.info("Dedup %s: %d/%d files shared, %.1f MiB saved", dest_path.name, stats.deduped,
+             stats.files, stats.bytes_saved / 1024**2)
+    return stats.as_dict()
+
+
+def summarize(layer_stats: list) -> dict:
+    """Adds up the dicts extract_layer returned for the layers of one pull."""
+    total = DedupStats().as_dict()
+    for stats in layer_stats:
+        for key in total:
+            total[key] += stats[key]
+    return total
+
+
+if __name__ == "__main__":
+    tracing.configure_logging()
+    mode = configs.LAYER_DEDUP if configs.LAYER_DEDUP != "off" else "hardlink"
+    store_stats = ContentStore(sys.argv[1] if len(sys.argv) > 1 else None, mode).stats()
+    print(f"{store_stats['objects']} objects, {store_stats['references']} references, "
+          f"{store_stats['bytes_stored'] / 1024**2:.1f} MiB stored, "
+          f"{store_stats['bytes_saved'] / 1024**2:.1f} MiB saved")
@@ -1,14 +1,16 @@
 import os
-import ctypes
 from pathlib import Path
-from app import configs
+from app import configs, libc
 import json
 import shutil
 import sys
+import logging
+from app import tracing
 
 
-libc = ctypes.CDLL('libc.so.6', use_errno=True)
+log = logging.getLogger(__name__)
 
+@tracing.traced("host_prep.create_overlay_filesystem")
 def create_overlay_filesystem(lowerdirs: list, upperdir: str, workdir: str, mountpoint: str):
     """
     Creates an overlay filesystem mount using ctypes to call the mount syscall.
@@ -19,38 +21,42 @@ def create_overlay_filesystem(lowerdirs: list, upperdir: str, workdir: str, moun
         workdir: A working directory, must be on the same filesystem as upperdir.
         mountpoint: The destination where the overlay filesystem will be mounted.
     """
-    print(lowerdirs, upperdir, workdir, mountpoint)
-    libc.mount.argtypes = (
-        ctypes.c_char_p,  # source
-        ctypes.c_char_p,  # target
-        ctypes.c_char_p,  # filesystemtype
-        ctypes.c_ulong,   # mountflags
-        ctypes.c_char_p   # data
-    )
+    log.debug("Overlay lowerdirs=%s upperdir=%s workdir=%s mountpoint=%s", lowerdirs, upperdir, workdir, mountpoint)
 
     # Prepare the mount options for overlayfs
     options = f"lowerdir={':'.join(lowerdirs)},upperdir={upperdir},workdir={workdir}"
-    print(options)
-    # Encode strings to bytes
-    source = b"overlay"
-    target = mountpoint.encode('utf-8')
-    filesystemtype = b"overlay"
-    data = options.encode('utf-8')
+    log.debug("Overlay options: %s", options)
 
     # The mountflags argument is not used for overlayfs, so it can be 0
-    mountflags = 0
-
-    # Call the mount function
-    ret = libc.mount(source, target, filesystemtype, mountflags, data)
-    if ret != 0:
-        errno = ctypes.get_errno()
-        raise OSError(errno or 1, f"Error mounting overlay filesystem: {os.strerror(errno) if errno else 'Mount failed'}")
-        
-def setup_filesystem(container_id):
-    image_name = container_id.split(':')[0]
-    safe_id = container_id.replace(':', '_').replace('/', '_')
-
-    crnt_base = Path(configs.CONTAINER_RUNTIME_ROOT_DIR)/safe_id
+    try:
+        libc.mount("overlay", mountpoint, "overlay", 0, options)
+    except OSError as e:
+        raise OSError(e.errno, f"Error mounting overlay filesystem: {os.strerror(e.errno)}") from e
+
+def container_runtime_dir(container_id: str) -> Path:
+    """Base of one container's overlay dirs and merged root."""
+    return Path(configs.CONTAINER_RUNTIME_ROOT_DIR)/container_id.replace(':', '_').replace('/', '_')
+
+@tracing.traced("host_prep.setup_filesystem")
+def setup_filesystem(image: str, container_id: str, mount_overlay: bool = True) -> list:
+    """
+    Prepares the runtime dirs of one container of `image` and mounts its overlay.
+
+    Every container gets its own upperdir, workdir and merged root, so two
+    containers of one image never share writes. teardown_filesystem()
+    removes them again.
+
+    Args:
+        mount_overlay: False leaves the mount to storage.ContainerStorage,
+                       which puts the upperdir on tmpfs in the container's
+                       own mount namespace.
+
+    Returns:
+        The image's lowerdirs.
+    """
+    image_name = image.split(':')[0]
+
+    crnt_base = container_runtime_dir(container_id)
     overlay_dir = crnt_base/"overlay"
     upper_dir = overlay_dir/"upperdir"
     workdir = overlay_dir/"workdir"
@@ -62,10 +68,10 @@ def setup_filesystem(container_id):
         try:
             os.makedirs(d, exist_ok=True)
         except Exception as e:
-            print(f"❌ Failed to create {d}: {e}")
+            log.error("❌ Failed to create %s: %s", d, e)
             raise
         else:
-            print(f"✅ Ensured dir: {d} (exists={os.path.isdir(d)})")
+            log.debug("✅ Ensured dir: %s", d)
 
     manifest_path = Path(configs.LOCAL_IMAGE_REGISTRY)/image_name/"manifests"/"config_manifest.json"
     if not manifest_path.exists():
@@ -80,11 +86,23 @@ def setup_filesystem(container_id):
         raise KeyError(f"config manifest missing rootfs.diff_ids: {e}")
 
     lowerdirs = [os.path.join(configs.EXTRACTED_LAYERS_PATH, layer_hash) for layer_hash in layers_hashes]
-    print(lowerdirs)
-    create_overlay_filesystem(lowerdirs, str(upper_dir), str(workdir), str(runt_dir))
-    print("Succesfully created overlay filesystem.")
+    if mount_overlay:
+        create_overlay_filesystem(lowerdirs, str(upper_dir), str(workdir), str(runt_dir))
+        log.info("Succesfully created overlay filesystem.")
     prepare_container_resolv_conf(configs.CONTAINER_RUNTIME_ROOT_DIR)
-    print("Succesfully copied DNS files.")
+    log.info("Succesfully copied DNS files.")
+    return lowerdirs
+
+
+@tracing.traced("host_prep.teardown_filesystem")
+def teardown_filesystem(container_id: str):
+    """Unmounts a container's overlay and deletes its upperdir, workdir and merged root."""
+    crnt_base = container_runtime_dir(container_id)
+    runt_dir = crnt_base/"runtime_dir"
+    if os.path.ismount(runt_dir):
+        libc.umount2(runt_dir, libc.MNT_DETACH)
+    shutil.rmtree(crnt_base, ignore_errors=True)
+    log.debug("[+] Removed runtime dir %s", crnt_base)
 
 
 def prepare_container_resolv_conf(container_workdir: str):
@@ -107,10 +125,10 @@ def prepare_container_resolv_conf(container_workdir: str):
 
     source_path = ""
     if os.path.exists(SYSTEMD_RESOLV_PATH):
-        print(f"[*] Found systemd-resolved config, using '{SYSTEMD_RESOLV_PATH}' as source.")
+        log.debug("[*] Found systemd-resolved config, using '%s' as source.", SYSTEMD_RESOLV_PATH)
         source_path = SYSTEMD_RESOLV_PATH
     else:
-        print(f"[*] Using traditional DNS config at '{TRADITIONAL_RESOLV_PATH}'.")
+        log.debug("[*] Using traditional DNS config at '%s'.", TRADITIONAL_RESOLV_PATH)
         source_path = TRADITIONAL_RESOLV_PATH
 
     destination_dir = os.path.join(container_workdir, "temp")
@@ -121,10 +139,10 @@ def prepare_container_resolv_conf(container_workdir: str):
     try:
         # We use copy, not copyfile, as it handles permissions better.
         shutil.copy(source_path, container_resolv_path)
-        print(f"[+] DNS config copied to '{container_resolv_path}' successfully.")
+        log.debug("[+] DNS config copied to '%s' successfully.", container_resolv_path)
         return container_resolv_path
     except Exception as e:
-        print(f"[!] Warning: Could not copy DNS config: {e}. Creating a fallback.")
+        log.warning("[!] Warning: Could not copy DNS config: %s. Creating a fallback.", e)
         # If all else fails, create a file with a public DNS server.
         with open(container_resolv_path, 'w') as f:
             f.write("nameserver 8.8.8.8\n")
@@ -135,5 +153,5 @@ def prepare_container_resolv_conf(container_workdir: str):
 
 
 if __name__ == "__main__":
-    
-    setup_filesystem(sys.argv[1])
+    tracing.configure_logging()
+    setup_filesystem(sys.argv[1], sys.argv[2])
@@ -0,0 +1,82 @@
+"""
+The one ctypes binding to libc shared by the whole runtime.
+
+libc is loaded once and the argument types of every function we call are
+declared here, so call sites cannot pass a str where the C side expects
+bytes. The wrappers raise OSError with the errno on failure and count each
+call for tracing.
+"""
+import os
+import sys
+import ctypes
+from app import tracing
+
+try:
+    libc = ctypes.CDLL('libc.so.6', use_errno=True)
+except OSError:
+    print("FATAL: libc.so.6 not found. This is required for namespaces and mounts.", file=sys.stderr)
+    sys.exit(1)
+
+# pivot_root has no glibc wrapper, it has to go through syscall(2).
+PIVOT_ROOT_SYSCALL = {"x86_64": 155, "aarch64": 41, "riscv64": 41, "armv7l": 218, "i686": 217, "ppc64le": 203, "s390x": 217}
+MNT_DETACH = 2
+
+libc.mount.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p)
+libc.mount.restype = ctypes.c_int
+libc.umount2.argtypes = (ctypes.c_char_p, ctypes.c_int)
+libc.umount2.restype = ctypes.c_int
+libc.unshare.argtypes = (ctypes.c_int,)
+libc.unshare.restype = ctypes.c_int
+libc.setns.argtypes = (ctypes.c_int, ctypes.c_int)
+libc.setns.restype = ctypes.c_int
+libc.sethostname.argtypes = (ctypes.c_char_p, ctypes.c_size_t)
+libc.sethostname.restype = ctypes.c_int
+libc.syscall.restype = ctypes.c_long
+
+
+def _encode(value):
+    if value is None or isinstance(value, bytes):
+        return value
+    return os.fsencode(value)
+
+
+def _check(ret: int, what: str):
+    if ret != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno or 1, f"{what} failed: {os.strerror(errno) if errno else 'unknown error'}")
+
+
+def mount(source, target, fstype=None, flags: int = 0, data=None):
+    tracing.count("syscall.mount")
+    _check(libc.mount(_encode(source), _encode(target), _encode(fstype), flags, _encode(data)),
+           f"mount {target}")
+
+
+def umount2(target, flags: int = 0):
+    tracing.count("syscall.umount2")
+    _check(libc.umount2(_encode(target), flags), f"umount {target}")
+
+
+def unshare(flags: int):
+    tracing.count("syscall.unshare")
+    _check(libc.unshare(flags), "unshare")
+
+
+def setns(fd: int, nstype: int = 0):
+    tracing.count("syscall.setns")
+    _check(libc.setns(fd, nstype), "setns")
+
+
+def sethostname(hostname: str):
+    tracing.count("syscall.sethostname")
+    name = hostname.encode('utf-8')
+    _check(libc.sethostname(name, len(name)), "sethostname")
+
+
+def pivot_root(new_root, put_old):
+    tracing.count("syscall.pivot_root")
+    syscall_num = PIVOT_ROOT_SYSCALL.get(os.uname().machine)
+    if syscall_num is None:
+        raise OSError(38, f"pivot_root: unknown syscall number for {os.uname().machine}") # ENOSYS
+    _check(libc.syscall(ctypes.c_long(syscall_num), ctypes.c_char_p(_encode(new_root)),
+                        ctypes.c_char_p(_encode(put_old))), "pivot_root")
@@ -0,0 +1,375 @@
+"""
+A small stand-in for an OCI distribution registry.
+
+It serves synthetic images generated on disk so `docker_pull` can be tested
+and benchmarked without network access. Only the read-only parts of the API
+that pull.py uses are implemented: tags, manifests, blobs and a token endpoint.
+"""
+import os
+import re
+import sys
+import json
+import time
+import gzip
+import base64
+import shutil
+import hashlib
+import secrets
+import tarfile
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from app import configs
+
+
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+LAYER_GZIP = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+LAYER_TAR = "application/vnd.docker.image.rootfs.diff.tar"
+IMAGE_CONFIG = "application/vnd.docker.container.image.v1+json"
+
+ROUTE = re.compile(r"^/v2/(?P<repo>.+)/(?P<kind>manifests|blobs)/(?P<ref>[^/]+)$")
+CHUNK_SIZE = 64 * 1024
+
+
+def _repo_dir(root, image_name: str, namespace: str) -> Path:
+    return Path(root)/namespace/image_name
+
+
+def _write_blob(blobs_dir: Path, data: bytes) -> dict:
+    digest = "sha256:" + hashlib.sha256(data).hexdigest()
+    (blobs_dir/digest).write_bytes(data)
+    return {"digest": digest, "size": len(data)}
+
+
+def _hash_file(path) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha.update(chunk)
+    return "sha256:" + sha.hexdigest()
+
+
+def _make_layer(blobs_dir: Path, index: int, size: int, compression: str, level: int) -> tuple:
+    """Writes one synthetic layer blob and returns (manifest entry, diff_id)."""
+    with tempfile.TemporaryDirectory() as tmp:
+        content = Path(tmp)/f"layer{index}"
+        content.mkdir()
+        with open(content/"data.txt", "wb") as f:
+            remaining = size
+            while remaining > 0:
+                # base64 of random bytes compresses roughly like text-heavy layers do
+                block = base64.b64encode(os.urandom(min(remaining, 3 * 1024 * 1024)))[:remaining]
+                f.write(block)
+                remaining -= len(block)
+
+        tar_path = Path(tmp)/"layer.tar"
+        with tarfile.open(tar_path, "w") as tar:
+            tar.add(content, arcname=f"layer{index}")
+        diff_id = _hash_file(tar_path)
+
+        blob_path = tar_path
+        if compression == "gzip":
+            blob_path = Path(tmp)/"layer.tar.gz"
+            with open(tar_path, "rb") as src, gzip.open(blob_path, "wb", compresslevel=level) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+        digest = _hash_file(blob_path)
+        entry = {
+            "mediaType": LAYER_GZIP if compression == "gzip" else LAYER_TAR,
+            "size": blob_path.stat().st_size,
+            "digest": digest,
+        }
+        shutil.move(blob_path, blobs_dir/digest)
+    return entry, diff_id
+
+
+def generate_image(root, image: str, layers: int = 3, layer_size: int = 8 * 1024**2,
+                   compression: str = "gzip", level: int = 6, namespace: str = configs.REGISTRY_NAMESPACE) -> dict:
+    """
+    Generates a synthetic linux/amd64 image under `root`.
+
+    Args:
+        image: name:tag of the image to create.
+        layer_size: Uncompressed payload bytes per layer.
+        compression: "gzip" or "none".
+        level: gzip compression level.
+
+    Returns:
+        A summary with the index digest and the total size of the layer blobs.
+    """
+    if compression not in ("gzip", "none"):
+        raise ValueError(f"Unsupported compression: {compression}")
+    image_name, tag = image.split(":")
+    repo = _repo_dir(root, image_name, namespace)
+    blobs_dir = repo/"blobs"
+    (repo/"tags").mkdir(parents=True, exist_ok=True)
+    blobs_dir.mkdir(parents=True, exist_ok=True)
+
+    layer_entries, diff_ids = [], []
+    for i in range(layers):
+        entry, diff_id = _make_layer(blobs_dir, i, layer_size, compression, level)
+        layer_entries.append(entry)
+        diff_ids.append(diff_id)
+
+    config = {"architecture": "amd64", "os": "linux", "config": {},
+              "rootfs": {"type": "layers", "diff_ids": diff_ids}}
+    config_entry = {"mediaType": IMAGE_CONFIG, **_write_blob(blobs_dir, json.dumps(config).encode())}
+    manifest = {"schemaVersion": 2, "mediaType": MANIFEST_V2, "config": config_entry, "layers": layer_entries}
+    manifest_entry = {"mediaType": MANIFEST_V2, **_write_blob(blobs_dir, json.dumps(manifest).encode()),
+                      "platform": {"architecture": "amd64", "os": "linux"}}
+    index = {"schemaVersion": 2, "mediaType": OCI_INDEX, "manifests": [manifest_entry]}
+    index_entry = _write_blob(blobs_dir, json.dumps(index).encode())
+    (repo/"tags"/tag).write_text(index_entry["digest"])
+
+    return {"image": image, "index_digest": index_entry["digest"],
+            "layer_bytes": sum(e["size"] for e in layer_entries), "layers": layers}
+
+
+class BandwidthShaper:
+    """Token-bucket style limit on the bytes/s all connections can send together."""
+    def __init__(self, bytes_per_second: float):
+        self.rate = bytes_per_second
+        self._lock = threading.Lock()
+        self._next_free = time.monotonic()
+
+    def consume(self, nbytes: int):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_free)
+            self._next_free = start + nbytes / self.rate
+            wait = self._next_free - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RegistryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "LocalRegistry"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _authorized(self, repo: str) -> bool:
+        if not self.server.require_auth:
+            return True
+        scheme, _, token = self.headers.get("Authorization", "").partition(" ")
+        if scheme == "Bearer" and token in self.server.tokens:
+            return True
+        realm = f"http://{self.server.server_address[0]}:{self.server.server_address[1]}/token"
+        challenge = f'Bearer realm="{realm}",service="local-registry",scope="repository:{repo}:pull"'
+        self._send_json(401, {"errors": [{"code": "UNAUTHORIZED"}]}, {"WWW-Authenticate": challenge})
+        return False
+
+    def _byte_range(self, size: int):
+        """
+        Returns the (start, end) of a single `bytes=` Range header, inclusive,
+        (0, size - 1) without one and None when it cannot be satisfied.
+        Multiple ranges are answered with the whole blob.
+        """
+        unit, _, spec = self.headers.get("Range", "").partition("=")
+        if unit.strip() != "bytes" or "," in spec:
+            return 0, size - 1
+        first, _, last = spec.strip().partition("-")
+        try:
+            if not first:
+                start, end = max(0, size - int(last)), size - 1 # suffix: the last N bytes
+            else:
+                start, end = int(first), min(int(last), size - 1) if last else size - 1
+        except ValueError:
+            return 0, size - 1
+        if start > end or start >= size:
+            return None
+        return start, end
+
+    def _send_file(self, path: Path, content_type: str, digest: str):
+        size = path.stat().st_size
+        byte_range = self._byte_range(size)
+        if byte_range is None:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start, end = byte_range
+        length = end - start + 1
+        self.send_response(206 if length < size else 200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        if length < size:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Docker-Content-Digest", digest)
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        shaper = self.server.shaper
+        with open(path, "rb") as f:
+            if shaper is None:
+                self.wfile.flush()
+                offset = start
+                while offset <= end:
+                    sent = os.sendfile(self.connection.fileno(), f.fileno(), offset, end + 1 - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                return
+            f.seek(start)
+            remaining = length
+            while remaining and (chunk := f.read(min(CHUNK_SIZE, remaining))):
+                shaper.consume(len(chunk))
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        path = self.path.split("?")[0]
+
+        if path == "/token":
+            token = secrets.token_hex(16)
+            self.server.tokens.add(token)
+            self._send_json(200, {"token": token, "access_token": token, "expires_in": 300})
+            return
+        if path in ("/v2", "/v2/"):
+            if self._authorized(""):
+                self._send_json(200, {})
+            return
+
+        match = ROUTE.match(path)
+        if not match:
+            self._send_json(404, {"errors": [{"code": "NAME_UNKNOWN"}]})
+            return
+        repo, kind, ref = match["repo"], match["kind"], match["ref"]
+        if not self._authorized(repo):
+            return
+
+        try:
+            found = self.server.lookup(repo, kind, ref, self.headers)
+        except TimeoutError as e:
+            self._send_json(504, {"errors": [{"code": "UNAVAILABLE", "message": str(e)}]})
+            return
+        if found is None:
+            code = "MANIFEST_UNKNOWN" if kind == "manifests" else "BLOB_UNKNOWN"
+            self._send_json(404, {"errors": [{"code": code}]})
+            return
+
+        blob_path, digest = found
+        content_type = "application/octet-stream"
+        if kind == "manifests" or blob_path.stat().st_size < 64 * 1024:
+            try:
+                content_type = json.loads(blob_path.read_bytes()).get("mediaType", content_type)
+            except (ValueError, UnicodeDecodeError, AttributeError):
+                pass
+        self._send_file(blob_path, content_type, digest)
+
+    do_HEAD = do_GET
+
+
+class LocalRegistry(ThreadingHTTPServer):
+    """
+    Serves images generated by `generate_image` from `root`.
+
+    Args:
+        bandwidth: Aggregate send limit in bytes/s, None for unlimited.
+        latency: Seconds added before every response.
+        require_auth: Challenge requests the way Docker Hub does and hand out
+                      tokens from /token.
+    """
+    daemon_threads = True
+
+    def __init__(self, root, host: str = "127.0.0.1", port: int = 0, bandwidth: float = None,
+                 latency: float = 0.0, require_auth: bool = False, verbose: bool = False):
+        super().__init__((host, port), RegistryHandler)
+        self.root = root
+        self.shaper = BandwidthShaper(bandwidth) if bandwidth else None
+        self.latency = latency
+        self.require_auth = require_auth
+        self.verbose = verbose
+        self.tokens = set()
+
+    def lookup(self, repo: str, kind: str, ref: str, headers=None):
+        """
+        Resolves a manifest or blob request to the file that answers it.
+
+        Returns (path, digest), or None when there is nothing to serve.
+        Raises TimeoutError when the answer did not become available in
+        time, which is sent as a 504.
+        """
+        repo_dir = Path(self.root)/repo
+        digest = ref
+        if kind == "manifests" and not ref.startswith("sha256:"):
+            tag_file = repo_dir/"tags"/ref
+            digest = tag_file.read_text().strip() if tag_file.exists() else None
+        blob_path = repo_dir/"blobs"/digest if digest else None
+        if blob_path is None or not blob_path.is_file():
+            return None
+        return blob_path, digest
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self) -> "LocalRegistry":
+        """Serves from a daemon thread and returns self."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local registry stand-in")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    gen = sub.add_parser("generate", help="Create a synthetic image")
+    gen.add_argument("root")
+    gen.add_argument("image", help="name:tag")
+    gen.add_argument("--layers", type=int, default=3)
+    gen.add_argument("--layer-size", type=float, default=8, help="MiB per layer, uncompressed")
+    gen.add_argument("--compression", choices=("gzip", "none"), default="gzip")
+    gen.add_argument("--level", type=int, default=6)
+
+    serve = sub.add_parser("serve", help="Serve the images under root")
+    serve.add_argument("root")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=5000)
+    serve.add_argument("--bandwidth", type=float, help="MiB/s")
+    serve.add_argument("--latency", type=float, default=0.0, help="milliseconds")
+    serve.add_argument("--auth", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.cmd == "generate":
+        summary = generate_image(args.root, args.image, args.layers, int(args.layer_size * 1024**2),
+                                 args.compression, args.level)
+        print(json.dumps(summary, indent=2))
+        return
+
+    registry = LocalRegistry(args.root, args.host, args.port,
+                             bandwidth=args.bandwidth * 1024**2 if args.bandwidth else None,
+                             latency=args.latency / 1000, require_auth=args.auth, verbose=True)
+    print(f"[+] Serving {args.root} at {registry.url}", file=sys.stderr)
+    try:
+        registry.serve_forever()
+    except KeyboardInterrupt:
+        registry.server_close()
+
+
+if __name__ == "__main__":
+    main()
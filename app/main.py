@@ -1,111 +1,138 @@
-import subprocess
-import shutil
 import sys
-import os
-import secrets
-from app.pull import docker_pull, docker_run
-from app import configs 
-import tempfile
-import uuid
+import time
+import logging
 from pathlib import Path
-from contextlib import contextmanager
-from app.configs import CGROUP_PATH, MEM_UNIT_MAP, LOCAL_IMAGE_REGISTRY
+from app import configs, tracing
 
+log = logging.getLogger(__name__)
 
-@contextmanager
-def manage_cgroup(image_name: str, mem_limit: str, cpu_percent: int):
-    """
-    A context manager to create, configure, and clean up a cgroup for a container.
+# Everything past this point is imported lazily: `run` of an image that is
+# already on disk should never load requests, pyroute2, tarfile or hashlib.
 
-    Yields:
-        The Path object for the created cgroup directory.
-    """
-    # 1. SETUP: Create a unique cgroup directory
-    cgroup_base = Path(CGROUP_PATH) / "mydocker"
-    cgroup_base.mkdir(exist_ok=True)
-    
-    container_id = f"{image_name.replace(':', '_')}_{uuid.uuid4().hex[:8]}"
-    cgroup_path = cgroup_base / container_id
-    cgroup_path.mkdir()
 
-    try:
-        (cgroup_base / "cgroup.subtree_control").write_text("+cpu +memory")
-    except OSError as e:
-        print(f"We got an error while creating cgroup.subtree_control: {e}", "We are ignoring it")
-        pass
+def image_is_local(image: str) -> bool:
+    image_name = image.split(':')[0]
+    return (Path(configs.LOCAL_IMAGE_REGISTRY)/image_name/"manifests"/"config_manifest.json").exists()
 
 
-    try:
+def pull(image: str):
+    from app.pull import docker_pull
+    dedup_stats = []
+    docker_pull(image, configs.LOCAL_IMAGE_REGISTRY, dedup_stats=dedup_stats)
+    if dedup_stats:
+        from app import dedup
+        total = dedup.summarize(dedup_stats)
+        print(f"Dedup: {total['deduped']}/{total['files']} files shared across {len(dedup_stats)} layers, "
+              f"{total['bytes_saved'] / 1024**2:.1f} MiB saved", file=sys.stderr)
 
-        if mem_limit:
-            amount = "".join(c for c in mem_limit.lower() if c.isdigit())
-            unit = "".join(c for c in mem_limit.lower() if not c.isdigit())
-            try:
-                amount_in_bytes = int(amount) * MEM_UNIT_MAP[unit]
-                (cgroup_path / "memory.max").write_text(str(amount_in_bytes))
-            except (KeyError, ValueError) as e:
-                print(f"Invalid memory limit format: {mem_limit}. Error: {e}", file=sys.stderr)
-        
-        if cpu_percent:
-            max_us = int(cpu_percent * 1000)
-            quota_us = 100000
-            (cgroup_path / "cpu.max").write_text(f"{max_us} {quota_us}")
-
-        yield cgroup_path
 
+def run(image: str, command: str, args: list, network: bool = True, storage=None):
+    if not image_is_local(image):
+        log.info("Image %s not found locally, pulling it.", image)
+        pull(image)
+
+    from app import state
+    from app.cgroups import manage_cgroup
+    from app.host_prep import setup_filesystem, teardown_filesystem
+    from app.processes import ProcessMananger
+    from app.storage import ContainerStorage
+
+    storage = storage or ContainerStorage()
+    container_id = state.new_container_id(image)
+    try:
+        storage.lowerdirs = setup_filesystem(image, container_id, mount_overlay=storage.rootfs == "disk")
+        storage.prepare_host()
+        with manage_cgroup(image, configs.CONTAINER_MEMORY_LIMIT, 20) as cgroup_path:
+            pm = ProcessMananger(" ".join([command, *args]), image, network=network, cgroup_path=cgroup_path,
+                                 storage=storage, container_id=container_id)
+            code = pm.run()
     finally:
-        try:
-            os.rmdir(cgroup_path)
-        except OSError as e:
-            print(f"Error cleaning up cgroup {cgroup_path}: {e}", file=sys.stderr)
-
-def perform_pivot(new_rt, put_old_rt):
-    pv_rt = libc.pivot_root
-    pv_rt.argtypes = [ctypes.c_char_p, ctypes.c_char_p]
-    pv_rt.restype = ctypes.c_int
-
-    if pv_rt(new_rt.encode("utf-8"), put_old_rt.encode("utf-8")) == -1:
-        errno = ctypes.get_errno()
-        print(f"Error during pivot_root: [Errno {errno}] {os.strerror(errno)}")
-        sys.exit(1)
-    else:
-        print(f"Successfully pivoted root to {new_root_path}, old root moved to {put_old_path}")
-    os.chdir("/")
-    print("Changed current working directory to /")
-
-def main(image):
-
-        command = sys.argv[3]
-        args = sys.argv[4:]
-        image_dir = docker_pull(image, LOCAL_IMAGE_REGISTRY)
-        runtime_dir = config"_".join(image.split(":"))
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # docker_run(temp_dir, image_dir)
-
-            shutil.copy("/etc/resolv.conf", os.path.join(temp_dir, "etc", "resolv.conf"))
-            chrooted_cmd = ["unshare", "-fp", "--mount-proc", "--", "chroot", temp_dir, command.split("/")[-1]]
-            try:
-                with manage_cgroup(image, "500MB", 20) as cgroup_path:
-                    
-                    container_process = subprocess.Popen([*chrooted_cmd, *args], stderr=sys.stderr,stdout=sys.stdout, stdin=sys.stdin, text=True)
-                    (cgroup_path/"cgroup.procs").write_text(str(container_process.pid))
-                    con_stdout, con_stderr = container_process.communicate()
-                    if con_stdout:
-                        print(con_stdout.strip(), file=sys.stdout)
-                    if con_stderr:
-                        print(con_stderr.strip(), file=sys.stderr)
-                    sys.exit(container_process.returncode)
-            except FileNotFoundError:
-                print("Error: Command not found.", file=sys.stderr)
-                sys.exit()
-            except Exception as e:                
-                print(f"An unexpected error occurred: {e}", file=sys.stderr)
-                raise(e)
-            
+        teardown_filesystem(container_id)
+    sys.exit(code)
+
+
+def ps():
+    """Lists the registered containers, `stale` when their process is gone."""
+    from app import state
+    print(f"{'CONTAINER ID':<32} {'PID':>7}  {'STATUS':<8} {'STARTED':<20} IMAGE")
+    for info in state.list_containers():
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(info.get("started", 0)))
+        status = "running" if state.is_running(info) else "stale"
+        print(f"{info['id']:<32} {info['pid']:>7}  {status:<8} {started:<20} {info['image']}")
+
 
+def parse_run_options(argv: list) -> tuple:
+    """
+    Splits the options in front of the image off a `run` command line.
 
+    Returns (network, storage, rest).
+    """
+    from app.storage import ContainerStorage, Volume, parse_size
+    network, rootfs, rootfs_size, volumes, scratch = True, None, None, [], []
+    args = iter(argv)
+    rest = []
+    for arg in args:
+        if arg == "--no-network":
+            network = False
+        elif arg == "--storage":
+            rootfs, _, size = next(args).partition("=")
+            rootfs_size = parse_size(size) if size else None
+            if rootfs_size and rootfs_size >= parse_size(configs.CONTAINER_MEMORY_LIMIT):
+                # tmpfs pages are charged to the cgroup, the container would be OOM killed before ENOSPC.
+                raise ValueError(f"--storage tmpfs size must be below the {configs.CONTAINER_MEMORY_LIMIT} memory limit")
+        elif arg in ("-v", "--volume"):
+            volumes.append(Volume.parse(next(args)))
+        elif arg == "--tmpfs":
+            target, _, size = next(args).partition("=")
+            scratch.append((target, parse_size(size or configs.TMPFS_SCRATCH_SIZE)))
+        else:
+            rest = [arg, *args]
+    return network, ContainerStorage(rootfs, rootfs_size, volumes, scratch), rest
+
+
+def usage():
+    print("Usage:\n"
+          "  run [--no-network] [--storage disk|tmpfs[=SIZE]] [-v NAME:/path[:tmpfs[=SIZE]|:file=SIZE]]\n"
+          "      [--tmpfs /path[=SIZE]] <image> <command> [args...]\n"
+          "  pull <image>\n"
+          "  ps\n"
+          "  logs [-f] [--tail N] <container>\n"
+          "  exec <container> <command> [args...]\n"
+          "  volume ls | volume rm [-f|--force] <name>...", file=sys.stderr)
+    sys.exit(1)
+
+
+def main(argv: list):
+    if not argv:
+        usage()
+    cmd, rest = argv[0], argv[1:]
+    if cmd == "logs":
+        from app import container_logs
+        container_logs.main(rest)
+    elif cmd == "exec":
+        from app import container_exec
+        container_exec.main(rest)
+    elif cmd == "volume":
+        from app import storage
+        storage.main(rest)
+    elif cmd == "ps":
+        ps()
+    elif cmd == "pull" and rest:
+        pull(rest[0])
+    elif cmd == "run" and rest:
+        try:
+            network, storage, rest = parse_run_options(rest)
+        except (ValueError, StopIteration) as e:
+            print(f"Error: {str(e) or 'missing option value'}", file=sys.stderr)
+            usage()
+        if len(rest) < 2:
+            usage()
+        log.debug("Image: %s", rest[0])
+        run(rest[0], rest[1], rest[2:], network=network, storage=storage)
+    else:
+        usage()
 
 
 if __name__ == "__main__":
-    print(sys.argv[2])
-    main(sys.argv[2])
+    tracing.configure_logging()
+    main(sys.argv[1:])
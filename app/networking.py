@@ -2,9 +2,13 @@ import subprocess
 from app import configs
 from app.configs import DEFAULT_BRIDGE_IP, DEFAULT_BRIDGE_NAME
 import os
+import logging
+from app import tracing
 from pyroute2 import IPRoute, NetNS
 from pyroute2.netlink.exceptions import NetlinkError
 
+log = logging.getLogger(__name__)
+
 
 class ContainerNetworkingManager:
     """
@@ -13,7 +17,7 @@ class ContainerNetworkingManager:
     def __init__(self, bridge_name: str = configs.DEFAULT_BRIDGE_NAME, bridge_ip="172.20.0.1/24", container_id: str = None):
         self.bridge_name = bridge_name
         self.bridge_ip = bridge_ip
-        self.ipr = IPRoute()
+        self.ipr = tracing.count_calls(IPRoute(), "netlink")
         self.container_id = container_id
     
 
@@ -23,7 +27,7 @@ class ContainerNetworkingManager:
         """
         Gets the name of the default network interface using pyroute2.
         """
-        with IPRoute() as ipr:
+        with tracing.count_calls(IPRoute(), "netlink") as ipr:
             # Get a list of all default routes, sorted by priority (metric).
             # We only care about IPv4 for this use case (family=2).
             default_routes = ipr.get_default_routes(family=2)
@@ -46,6 +50,7 @@ class ContainerNetworkingManager:
     
 
 
+    @tracing.traced("networking.ensure_nat_masquerading")
     def ensure_nat_masquerading(self, bridge_name: str, bridge_subnet: str, public_iface: str):
         """
         Ensures that NAT masquerading and necessary forwarding rules are in place.
@@ -53,8 +58,8 @@ class ContainerNetworkingManager:
         if os.geteuid() != 0:
             raise PermissionError("iptables operations require root privileges.")
 
-        print("--- Ensuring NAT and forwarding rules ---")
-        print(f"Using {public_iface} for NAT masqarading!")
+        log.debug("--- Ensuring NAT and forwarding rules ---")
+        log.debug("Using %s for NAT masqarading!", public_iface)
         # Define the rules we need to enforce
         rules = [
             # 1. The main NAT masquerade rule
@@ -93,32 +98,33 @@ class ContainerNetworkingManager:
             rule_exists = subprocess.call(check_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
 
             if not rule_exists:
-                print(f"[+] Adding rule: {rule_spec['description']}")
+                log.debug("[+] Adding rule: %s", rule_spec['description'])
                 # Construct the command to add the rule
                 add_cmd = ["iptables", "-t", table, "-A", chain] + rule
                 # Run the command, raising an exception on failure
                 subprocess.run(add_cmd, check=True)
             else:
-                print(f"[*] Rule already exists: {rule_spec['description']}")
+                log.debug("[*] Rule already exists: %s", rule_spec['description'])
 
-        print("--- NAT and forwarding rules are in place ---")
+        log.debug("--- NAT and forwarding rules are in place ---")
 
 
     # --- Example Usage in your Host Setup ---
 
 
+    @tracing.traced("networking.setup_host_infrastructure")
     def setup_host_infrastructure(self):
         """
         Sets up the host-level bridge. This is an idempotent operation.
         """
-        print("--- Setting up host networking infrastructure ---")
+        log.debug("--- Setting up host networking infrastructure ---")
         try:
             # 1. Create the Bridge
             self.ipr.link("add", ifname=self.bridge_name, kind="bridge")
-            print(f"[+] Bridge '{self.bridge_name}' created.")
+            log.debug("[+] Bridge '%s' created.", self.bridge_name)
         except NetlinkError as e:
             if e.code == 17: # EEXIST - File exists
-                print(f"[*] Bridge '{self.bridge_name}' already exists.")
+                log.debug("[*] Bridge '%s' already exists.", self.bridge_name)
             else:
                 raise
 
@@ -130,20 +136,21 @@ class ContainerNetworkingManager:
             # Note: The IP is passed as two args: address and mask
             addr, mask = self.bridge_ip.split('/')
             self.ipr.addr("add", index=bridge_idx, address=addr, mask=int(mask))
-            print(f"[+] IP {self.bridge_ip} assigned to bridge.")
+            log.debug("[+] IP %s assigned to bridge.", self.bridge_ip)
         except NetlinkError as e:
             if e.code == 17: # EEXIST
-                print(f"[*] IP {self.bridge_ip} already assigned to bridge.")
+                log.debug("[*] IP %s already assigned to bridge.", self.bridge_ip)
             else:
                 raise
         
         # 3. Activate the Bridge
         self.ipr.link("set", index=bridge_idx, state="up")
-        print(f"[+] Bridge '{self.bridge_name}' is up.")
+        log.debug("[+] Bridge '%s' is up.", self.bridge_name)
 
         self.ensure_nat_masquerading(self.bridge_name, DEFAULT_BRIDGE_IP, self.get_default_interface_pyroute2())
-        print("--- Host infrastructure setup complete ---")
+        log.info("--- Host infrastructure setup complete ---")
 
+    @tracing.traced("networking.wire_container")
     def wire_container(self, child_pid: int, container_ip: str, veth_suffix: str):
         """
         Wires up a specific container by creating a veth pair and configuring it.
@@ -153,53 +160,53 @@ class ContainerNetworkingManager:
             container_ip (str): The IP address to assign to the container (e.g., "172.20.0.2/24").
             veth_suffix (str): A unique suffix for the veth pair (e.g., the container ID).
         """
-        print(f"\n--- Wiring up container with PID {child_pid} ---")
+        log.debug("--- Wiring up container with PID %s ---", child_pid)
         bridge_idx = self.ipr.link_lookup(ifname=self.bridge_name)[0]
         veth_host = f"vh-{veth_suffix}"
         veth_container = f"vc-{veth_suffix}"
 
         # 1. Create the veth Pair
         self.ipr.link("add", ifname=veth_host, kind="veth", peer=veth_container)
-        print(f"[+] Created veth pair: {veth_host} <--> {veth_container}")
+        log.debug("[+] Created veth pair: %s <--> %s", veth_host, veth_container)
 
         # 2. Connect the Host End to the Bridge
         veth_host_idx = self.ipr.link_lookup(ifname=veth_host)[0]
         self.ipr.link("set", index=veth_host_idx, master=bridge_idx)
         self.ipr.link("set", index=veth_host_idx, state="up")
-        print(f"[+] Attached '{veth_host}' to bridge '{self.bridge_name}'.")
+        log.debug("[+] Attached '%s' to bridge '%s'.", veth_host, self.bridge_name)
 
         # 3. Move the Container End into the Namespace
         veth_container_idx = self.ipr.link_lookup(ifname=veth_container)[0]
         self.ipr.link("set", index=veth_container_idx, net_ns_pid=child_pid)
-        print(f"[+] Moved '{veth_container}' into namespace of PID {child_pid}.")
+        log.debug("[+] Moved '%s' into namespace of PID %s.", veth_container, child_pid)
 
         # 4. Configure the Interface *Inside* the Namespace
         #    We use the NetNS object to run commands within the child's namespace.
-        with NetNS(f"/proc/{child_pid}/ns/net") as ns:
-            print(f"[+] Switched to namespace of PID {child_pid} for configuration.")
+        with tracing.count_calls(NetNS(f"/proc/{child_pid}/ns/net"), "netlink") as ns:
+            log.debug("[+] Switched to namespace of PID %s for configuration.", child_pid)
             
             # Get the index of the interface *inside* the new namespace
             cont_idx = ns.link_lookup(ifname=veth_container)[0]
             
             # a. Rename the interface to 'eth0'
             ns.link("set", index=cont_idx, ifname="eth0")
-            print("    - Renamed interface to 'eth0'.")
+            log.debug("    - Renamed interface to 'eth0'.")
             
             # b. Assign the IP address
             addr, mask = container_ip.split('/')
             ns.addr("add", index=cont_idx, address=addr, mask=int(mask))
-            print(f"    - Assigned IP {container_ip} to 'eth0'.")
+            log.debug("    - Assigned IP %s to 'eth0'.", container_ip)
 
             # c. Activate the interface
             ns.link("set", index=cont_idx, state="up")
-            print("    - Set 'eth0' state to 'up'.")
+            log.debug("    - Set 'eth0' state to 'up'.")
 
             # d. Set the default gateway
             gateway_ip = self.bridge_ip.split('/')[0]
             ns.route("add", gateway=gateway_ip)
-            print(f"    - Set default gateway to {gateway_ip}.")
+            log.debug("    - Set default gateway to %s.", gateway_ip)
         
-        print("--- Container wiring complete ---")
+        log.info("--- Container wiring complete ---")
 
     def cleanup(self):
         """Closes the IPRoute socket."""
@@ -209,6 +216,7 @@ class ContainerNetworkingManager:
 if __name__ == "__main__":
     # This would be in your parent's `else` block after forking.
     # We'll simulate it here.
+    tracing.configure_logging("DEBUG")
     
     # Assume a child process has been forked and is waiting.
     # We'll create a dummy namespace to simulate the child.
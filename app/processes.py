@@ -1,139 +1,233 @@
 import os
-import ctypes
 from app.constants import COMMON_LIBC_FLAGS as uflags
-from app import configs, cont_prep
-from app.networking import ContainerNetworkingManager
+from app import configs, cont_prep, libc, state, storage
+from app.container_logs import ContainerLogger
 # imports at top
-from app.host_prep import prepare_container_resolv_conf
+from app.host_prep import container_runtime_dir, prepare_container_resolv_conf
 import sys
 from pathlib import Path
 import tempfile
-import uuid
+import json
+import time
+import logging
+from app import tracing
+
+log = logging.getLogger(__name__)
+
+# Exit code of a container that failed before its command ran, as docker run uses it.
+SETUP_FAILED = 125
+
+
+def exit_code(status: int) -> int:
+    """Shell-style exit code from a wait status: the command's own, or 128 + signal if it was killed."""
+    code = os.waitstatus_to_exitcode(status)
+    return 128 - code if code < 0 else code
+
 
-libc = ctypes.CDLL('libc.so.6', use_errno=True)
 class ProcessMananger:
-    def __init__(self, command, image):
+    def __init__(self, command, image, container_ip="172.16.7.10/24", veth_suffix="test1234",
+                 network=True, mirror_output=True, cgroup_path=None, storage=None, container_id=None):
         self.image = image
+        # The id setup_filesystem() prepared the runtime dir under.
+        self.container_id = container_id or state.new_container_id(image)
+        self.storage = storage
+        self.cgroup_path = cgroup_path
         self.command = command
-        print(self.command)
-    def run(self):
+        self.container_ip = container_ip
+        self.veth_suffix = veth_suffix
+        self.network = network
+        self.mirror_output = mirror_output
+        # Seconds spent in each start-up phase of the last run(), keyed by phase name.
+        self.timings = {}
+        self.exit_code = None
+        log.debug("Command: %s", self.command)
+
+    @tracing.traced("processes.run")
+    def run(self) -> int:
+        """Runs the container in the foreground and returns the command's exit code."""
         child_sig_rd, child_sig_wr = os.pipe()
         parent_sig_rd, parent_sig_wr = os.pipe()
-        container_unique_id = "_".join(self.image.split(":")) + "-" + str(uuid.uuid4())[:5]
-        
-
-        runtime_dir = Path(configs.CONTAINER_RUNTIME_ROOT_DIR)/"_".join(self.image.split(":"))/"runtime_dir"
-        os.makedirs(Path(runtime_dir)/"old_root", exist_ok=True)
-
-        target_host_uid = 1000
-        target_host_gid = 1000
-        print(f"[Parent] Changing ownership of '{runtime_dir}' to {target_host_uid}:{target_host_gid}")
-        os.chown(runtime_dir, target_host_uid, target_host_gid)
-        # Also chown the subdirectory for the old_root
-        os.chown(Path(runtime_dir)/"old_root", target_host_uid, target_host_gid)
+        # The child reports its own phase timestamps through this pipe.
+        timing_rd, timing_wr = os.pipe()
+        container_unique_id = self.container_id
+        runtime_dir = container_runtime_dir(container_unique_id)/"runtime_dir"
+        if self.storage is None or self.storage.rootfs == "disk":
+            # A tmpfs rootfs only exists in the container's mount namespace, the helper prepares it there.
+            log.debug("[Parent] Preparing mount points in '%s'", runtime_dir)
+            storage.prepare_mountpoints(runtime_dir)
+        logger = ContainerLogger(container_unique_id)
+        log.info("[Parent] Logging container output to %s", logger.log_path)
+        fork_start = time.monotonic()
+        tracing.count("syscall.fork")
         child_pid = os.fork()
         if child_pid == 0:
-            print(f"Hello from the Child: {child_pid}")
-            libc.unshare(uflags.CLONE_NEWUSER |
-                          uflags.CLONE_NEWIPC | 
-                          uflags.CLONE_NEWNS | 
-                          uflags.CLONE_NEWNET |
-                          uflags.CLONE_NEWPID |
-                          uflags.CLONE_NEWCGROUP |
-                          uflags.CLONE_NEWUTS)
+            code = SETUP_FAILED
+            try:
+                os.close(timing_rd)
+                log.debug("Hello from the Child: %s", os.getpid())
+                libc.unshare(uflags.CLONE_NEWUSER |
+                              uflags.CLONE_NEWIPC | 
+                              uflags.CLONE_NEWNS | 
+                              uflags.CLONE_NEWNET |
+                              uflags.CLONE_NEWPID |
+                              uflags.CLONE_NEWCGROUP |
+                              uflags.CLONE_NEWUTS)
+                child_marks = {"unshared": time.monotonic()}
             
-            # Created uid and gid mapping for the container
-            os.close(child_sig_rd)
-            os.write(child_sig_wr, b"1")
-            print("[Child]: Waiting for the parent to create uid mapping")
-            os.read(parent_sig_rd, 1)
-            print("[Child] Continuing execution")
-            os.close(parent_sig_rd)
-            os.setuid(0)
-            os.setgid(0)
-
-            cont_prep.set_container_hostname(container_unique_id)
-
-
-
-
-            # Perform pivot root
-
-            libc.mount(None, "/", None, uflags.MS_REC | uflags.MS_PRIVATE, None)
-            libc.mount(str(runtime_dir).encode("utf-8"), str(runtime_dir).encode("utf-8"), None, uflags.MS_BIND, None)
-            # BEFORE pivot_root (and after you’ve ensured runtime_dir/etc exists)
-            source_resolv_path = f"{configs.CONTAINER_RUNTIME_ROOT_DIR}/temp/resolv.conf"
-            target_resolv_path = os.path.join(str(runtime_dir), "etc", "resolv.conf")
-
-            print("[*] Pre-pivot: bind-mount DNS file into future root...")
-            if libc.mount(source_resolv_path.encode(), target_resolv_path.encode(), None, uflags.MS_BIND, None) != 0:
-                errno = ctypes.get_errno()
-                raise OSError(errno or 1, f"Failed to bind mount resolv.conf: {os.strerror(errno) if errno else 'mount failed'}")
-            print("[+] DNS file bind-mounted into runtime_dir.")
-
-            os.chdir(runtime_dir)
-            # TODO: Make this retrive the syscall number based on the current architecture
-            syscall_num = 155
-            ret = libc.syscall(syscall_num, ".", "./old_root") # pivot root sys call
-            if ret != 0:
-                errno = ctypes.get_errno()
-                raise OSError(errno, f"pivot_root failed: {os.strerror(errno)}")
-      
-
-
-        
-            libc.umount2("old_root".encode(), 2) # 2 is MNT_DETACH
-            os.rmdir("./old_root")
-            libc.mount("proc".encode(), "proc".encode(), "proc".encode(), 0, None)
-            print("Running command")
-            os.system(f"{self.command}")
-            os._exit(1)
+                # Created uid and gid mapping for the container
+                os.close(child_sig_rd)
+                os.write(child_sig_wr, b"1")
+                log.debug("[Child]: Waiting for the parent to create uid mapping")
+                os.read(parent_sig_rd, 1)
+                log.debug("[Child] Continuing execution")
+                os.close(parent_sig_rd)
+                os.setuid(0)
+                os.setgid(0)
+
+                cont_prep.set_container_hostname(container_unique_id)
+
+
+
+
+                # Perform pivot root
+                with tracing.span("processes.pivot_root"):
+                    child_marks["pivot_start"] = time.monotonic()
+                    libc.mount(None, "/", None, uflags.MS_REC | uflags.MS_PRIVATE, None)
+                    # Recursive, so volumes mounted under the root come along.
+                    libc.mount(runtime_dir, runtime_dir, None, uflags.MS_BIND | uflags.MS_REC, None)
+                    # BEFORE pivot_root (and after you’ve ensured runtime_dir/etc exists)
+                    source_resolv_path = f"{configs.CONTAINER_RUNTIME_ROOT_DIR}/temp/resolv.conf"
+                    target_resolv_path = os.path.join(str(runtime_dir), "etc", "resolv.conf")
+
+                    log.debug("[*] Pre-pivot: bind-mount DNS file into future root...")
+                    libc.mount(source_resolv_path, target_resolv_path, None, uflags.MS_BIND, None)
+                    log.debug("[+] DNS file bind-mounted into runtime_dir.")
+
+                    os.chdir(runtime_dir)
+                    libc.pivot_root(".", "./old_root")
+                child_marks["pivot_end"] = time.monotonic()
+                # unshare(CLONE_NEWPID) only applies to our children: fork once
+                # more so the command runs as pid 1 of the new namespace, the
+                # only place its /proc can be mounted from.
+                tracing.flush()
+                init_pid = os.fork()
+                if init_pid == 0:
+                    self._exec_init(logger, timing_wr, child_marks)
+                logger.close_all()
+                os.close(timing_wr)
+                _, status = os.waitpid(init_pid, 0)
+                code = exit_code(status)
+            except BaseException as e:
+                # Never let the child fall back into the caller's code.
+                log.error("[Child] FATAL: %s", e)
+                tracing.flush()
+            os._exit(code)
             
             
         else:
-            print(f"I am the parent: {os.getpid()}")
-            print(f"Parent says, my child's PID is: {child_pid}")    
-            print("Parent is setting up uid and gid mapping")
+            log.debug("I am the parent: %s, my child's PID is: %s", os.getpid(), child_pid)
+            log.debug("Parent is setting up uid and gid mapping")
             os.close(parent_sig_rd)
+            os.close(child_sig_wr) # So a child that dies early reads as EOF below
+            os.close(timing_wr)
+            logger.close_child_ends()
             os.read(child_sig_rd, 1)
             # in the parent branch, after os.read(child_sig_rd, 1) and before writing the parent signal:
             dns_src = prepare_container_resolv_conf(configs.CONTAINER_RUNTIME_ROOT_DIR)
-            print(f"[Parent] Prepared DNS source at: {dns_src}")
-            net_manager = ContainerNetworkingManager(configs.DEFAULT_BRIDGE_NAME, configs.DEFAULT_BRIDGE_IP)        
-            # 1. Set up the host bridge (only needs to be done once)
-            net_manager.setup_host_infrastructure()
+            log.debug("[Parent] Prepared DNS source at: %s", dns_src)
+            if self.network:
+                # pyroute2 is heavy, only pay for it when the container gets a network.
+                from app.networking import ContainerNetworkingManager
+                phase_start = time.monotonic()
+                net_manager = ContainerNetworkingManager(configs.DEFAULT_BRIDGE_NAME, configs.DEFAULT_BRIDGE_IP)        
+                # 1. Set up the host bridge (only needs to be done once)
+                net_manager.setup_host_infrastructure()
+                self.timings["setup_host_infrastructure"] = time.monotonic() - phase_start
 
             try:
-                with open(f"/proc/{child_pid}/setgroups", "w") as f:
-                    f.write("deny")
-                with open(f"/proc/{child_pid}/gid_map", "w") as f:
-                    f.write("0 1000 1\n") # Map to user 1000 (e.g., your normal user)
-                with open(f"/proc/{child_pid}/uid_map", "w") as f:
-                    f.write("0 1000 1\n")
-                os.makedirs(os.path.join(runtime_dir, 'etc'), exist_ok=True)
-
-                with open(os.path.join(runtime_dir, 'etc/resolv.conf'), 'w'): pass
-                os.makedirs(os.path.join(runtime_dir, 'sys'), exist_ok=True)
-
-                print("[Parent] UID/GID maps written successfully.")
-                net_manager.wire_container(
-                    child_pid=child_pid,
-                    container_ip="172.16.7.10/24",
-                    veth_suffix="test1234"
-                )
+                phase_start = time.monotonic()
+                with tracing.span("processes.uid_gid_map", pid=child_pid):
+                    with open(f"/proc/{child_pid}/setgroups", "w") as f:
+                        f.write("deny")
+                    with open(f"/proc/{child_pid}/gid_map", "w") as f:
+                        f.write("0 1000 1\n") # Map to user 1000 (e.g., your normal user)
+                    with open(f"/proc/{child_pid}/uid_map", "w") as f:
+                        f.write("0 1000 1\n")
+                self.timings["uid_gid_map"] = time.monotonic() - phase_start
+                if self.cgroup_path is not None:
+                    # Before the child is released, so everything it runs is accounted.
+                    (Path(self.cgroup_path)/"cgroup.procs").write_text(str(child_pid))
+                if self.storage is not None and self.storage.needs_mounts:
+                    phase_start = time.monotonic()
+                    self.storage.mount_into(child_pid, runtime_dir, self.cgroup_path)
+                    self.timings["mount_storage"] = time.monotonic() - phase_start
+
+                log.debug("[Parent] UID/GID maps written successfully.")
+                if self.network:
+                    phase_start = time.monotonic()
+                    net_manager.wire_container(
+                        child_pid=child_pid,
+                        container_ip=self.container_ip,
+                        veth_suffix=self.veth_suffix
+                    )
+                    self.timings["wire_container"] = time.monotonic() - phase_start
                 os.write(parent_sig_wr, b"1")
                 os.close(parent_sig_wr)
-                
-                _, status = os.waitpid(child_pid, 0)
+
+                volumes = [volume.name for volume in self.storage.volumes] if self.storage is not None else []
+                state.register_container(container_unique_id, child_pid, self.image, self.cgroup_path, volumes)
+                log.info("[Parent] Started container %s", container_unique_id)
+                if self.mirror_output:
+                    print(container_unique_id, flush=True)
+                try:
+                    logger.pump(mirror=self.mirror_output)
+                    _, status = os.waitpid(child_pid, 0)
+                finally:
+                    state.unregister_container(container_unique_id)
+                self._collect_child_timings(timing_rd, fork_start, logger.first_output_at)
+                self.exit_code = exit_code(status)
+                return self.exit_code
 
             except Exception as e:
-                print(f"[Parent] FATAL: Could not write maps: {e}", file=sys.stderr)
+                log.error("[Parent] FATAL: Could not write maps: %s", e)
                 os.kill(child_pid, 9) # Kill the child if mapping fails
                 sys.exit(1)
 
+    def _exec_init(self, logger, timing_wr, child_marks):
+        """Runs as the container's pid 1: mounts /proc, drops the old root and execs the command. Never returns."""
+        try:
+            # Before old_root goes: a user namespace may only mount a proc
+            # while another, fully visible one is still in its mount namespace.
+            libc.mount("proc", "/proc", "proc", 0, None)
+            libc.umount2("/old_root", libc.MNT_DETACH)
+            os.rmdir("/old_root")
+            log.debug("Running command")
+            tracing.flush() # exec skips the atexit flush
+            logger.redirect_child()
+            child_marks["exec"] = time.monotonic()
+            os.write(timing_wr, json.dumps(child_marks).encode())
+            os.close(timing_wr)
+            os.execv("/bin/sh", ["sh", "-c", self.command])
+        except BaseException as e:
+            log.error("[Init] FATAL: %s", e)
+            tracing.flush()
+        os._exit(SETUP_FAILED)
+
+    def _collect_child_timings(self, timing_rd, fork_start, first_output_at):
+        with os.fdopen(timing_rd, "rb") as f:
+            data = f.read()
+        if not data:
+            return # The child died before it reached exec
+        marks = json.loads(data)
+        self.timings["fork_unshare"] = marks["unshared"] - fork_start
+        self.timings["pivot_root"] = marks["pivot_end"] - marks["pivot_start"]
+        if first_output_at is not None:
+            self.timings["exec_first_instruction"] = first_output_at - marks["exec"]
+
 
 
 
 if __name__ == "__main__":
+    tracing.configure_logging()
     pm = ProcessMananger(" ".join(sys.argv[2:]), sys.argv[1])
-    pm.run()
\ No newline at end of file
+    sys.exit(pm.run())
\ No newline at end of file
@@ -2,49 +2,139 @@ import sys
 import requests, tarfile
 from pathlib import Path
 import os
-from app.configs import LOCAL_IMAGE_REGISTRY, SESSION_DATA_PATH, LAYER_BLOB_PATH, EXTRACTED_LAYERS_PATH
+from app import configs
 import  json
 import gzip
 import hashlib
+import fcntl
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from app import tracing
 
 import shutil
 
+log = logging.getLogger(__name__)
+
+@tracing.traced("pull.hash_layer")
 def sha256_of_tgz_stream(filepath):
     sha256_hash = hashlib.sha256()
     block_size = 65536  # You can adjust this value for performance
     try:
-        with gzip.open(filepath, 'rb') as f:
+        with open(filepath, 'rb') as raw:
+            is_gzip = raw.read(2) == b"\x1f\x8b"
+        # Uncompressed layers are hashed as they are, their digest is the diff_id.
+        opener = gzip.open if is_gzip else open
+        with opener(filepath, 'rb') as f:
             while True:
                 chunk = f.read(block_size)
                 if not chunk:
                     break
                 sha256_hash.update(chunk)
     except FileNotFoundError:
-        print(f"Error: The file '{filepath}' was not found.")
+        log.error("Error: The file '%s' was not found.", filepath)
         return None
     except Exception as e:
-        print(f"An error occurred: {e}")
+        log.error("An error occurred: %s", e)
         return None
 
     return sha256_hash.hexdigest()
 
 
-def download_layer(download_url, digest: str, auth_data, dir):
+def _hash_file_object(f) -> str:
+    f.seek(0)
+    sha = hashlib.sha256()
+    while chunk := f.read(1024 * 1024):
+        sha.update(chunk)
+    return f"sha256:{sha.hexdigest()}"
+
+
+def _lock_partial(partial_path: Path, blob_path: Path):
+    """
+    Opens `partial_path` and takes its exclusive flock.
+
+    Whoever held the lock before may have renamed the partial into place or
+    removed it, the file is reopened until the locked one is still the
+    partial (or the blob is there).
+    """
+    while True:
+        f = open(partial_path, "a+b")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            current = os.stat(partial_path).st_ino == os.fstat(f.fileno()).st_ino
+        except FileNotFoundError:
+            current = False
+        if current or blob_path.exists():
+            return f
+        f.close()
+
+
+def download_layer(download_url, digest: str, auth_data, dir, timeout=None):
+    """
+    Downloads the blob `digest` into `dir` and checks it against its digest.
+
+    The download goes to `<digest>.partial` under an exclusive flock, so two
+    processes fetching the same blob wait for each other instead of
+    downloading it twice, and a partial left by a failed source is resumed
+    with a Range request from the next one. The finished file is hashed as it
+    is on disk before it is renamed into place.
+
+    Raises:
+        ValueError: The downloaded content does not match `digest`.
+    """
     download_path = Path(dir)
     download_path.mkdir(parents=True, exist_ok=True)
-    if (download_path/digest).exists():
-        print(f"Image {download_url} exists locally.")
-        return download_path/digest
-    
-    with requests.get(download_url, headers=auth_data, stream=True) as rsp:
-        rsp.raise_for_status()
-
-        with open(download_path/digest, "wb") as f:
+    blob_path = download_path/digest
+    if blob_path.exists():
+        log.debug("Image %s exists locally.", download_url)
+        return blob_path
+
+    partial_path = download_path/f"{digest}.partial"
+    with _lock_partial(partial_path, blob_path) as f:
+        if blob_path.exists():
+            # Someone else finished it while we waited for the lock.
+            partial_path.unlink(missing_ok=True)
+            return blob_path
+        # What the previous holder left, not the size when we opened the file.
+        offset = os.fstat(f.fileno()).st_size
+        headers = {**auth_data, "Range": f"bytes={offset}-"} if offset else auth_data
+
+        with tracing.span("pull.download_layer", digest=digest) as span, \
+                requests.get(download_url, headers=headers, stream=True, timeout=timeout) as rsp:
+            rsp.raise_for_status()
+            if offset and rsp.status_code != 206:
+                log.debug("%s ignored the Range request, starting over.", download_url)
+                f.truncate(0)
+                offset = 0
+
+            size = 0
             for chunk in rsp.iter_content(chunk_size=1024 * 1024):
                 if chunk:
-                    f.write(chunk)
-    return download_path/digest
+                    size += f.write(chunk)
+            span.set(bytes=size, resumed_at=offset)
 
+        f.flush()
+        if _hash_file_object(f) != digest:
+            partial_path.unlink()
+            raise ValueError(f"Blob from {download_url} does not match {digest}")
+        os.replace(partial_path, blob_path)
+    return blob_path
+
+
+def cache_blob(data: bytes, dir=None) -> str:
+    """Stores `data` in the blob dir under its own digest and returns the digest."""
+    download_path = Path(dir or configs.LAYER_BLOB_PATH)
+    download_path.mkdir(parents=True, exist_ok=True)
+    digest = "sha256:" + hashlib.sha256(data).hexdigest()
+    if not (download_path/digest).exists():
+        fd, tmp_path = tempfile.mkstemp(dir=download_path, prefix=".blob")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, download_path/digest)
+    return digest
+
+@tracing.traced("pull.extract_layer")
 def extract_layer(layer_path, dest_path):
     os.makedirs(dest_path, exist_ok=True)
     with tarfile.open(layer_path, mode="r:*") as tar:
@@ -57,78 +147,249 @@ def parse_auth_data(data: str):
     data_map = {a:b for a,b in data_pairs}
     return data_map
 
-def auth_docker(pull_url):
-    rsp = requests.get(pull_url)
-    print("Status code: ", rsp.status_code)
-    print(rsp.text)
-    print(rsp.headers)
-    token_scheme, auth_data = rsp.headers.get("www-authenticate").split(" ")
+def load_session(registry: str):
+    """Returns the cached (token, scheme) for `registry`, or (None, None)."""
+    try:
+        with open(configs.SESSION_DATA_PATH, "r") as f:
+            session_data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None, None
+    registry_session = session_data.get(registry, {})
+    return registry_session.get("token"), registry_session.get("scheme")
+
+@tracing.traced("pull.auth")
+def auth_docker(pull_url, registry: str = None, timeout: float = None):
+    registry = registry or configs.REGISTRY_URL
+    rsp = requests.get(pull_url, timeout=timeout)
+    log.debug("Auth challenge status code: %s headers: %s", rsp.status_code, rsp.headers)
+    www_authenticate = rsp.headers.get("www-authenticate")
+    if not www_authenticate:
+        # Registries without auth (e.g. a local mirror) accept anonymous pulls.
+        return "", ""
+    token_scheme, auth_data = www_authenticate.split(" ")
     auth_data_map = parse_auth_data(auth_data)
     auth_params = {
         "service": auth_data_map["service"],
         "scope"  : auth_data_map["scope"],
     }
-    token_data = requests.get(auth_data_map.get("realm"), params=auth_params)
+    token_data = requests.get(auth_data_map.get("realm"), params=auth_params, timeout=timeout)
     token = token_data.json().get("token")
-    session_data = dict()
-    with open(SESSION_DATA_PATH, "w") as f:
-        session_data["token"] = token
-        session_data["scheme"] = token_scheme
+    try:
+        with open(configs.SESSION_DATA_PATH, "r") as f:
+            session_data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        session_data = dict()
+    # Tokens are only valid for the registry that issued them.
+    session_data[registry] = {"token": token, "scheme": token_scheme}
+    with open(configs.SESSION_DATA_PATH, "w") as f:
         json.dump(session_data, f)
     return token, token_scheme
 
-def docker_pull(image, dest_dir):
+def auth_headers(token, token_scheme) -> dict:
+    return {"Authorization": f"{token_scheme} {token}"} if token else {}
+
+def repository_url(image_name: str, registry: str = None) -> str:
+    registry = (registry or configs.REGISTRY_URL).rstrip("/")
+    return f"{registry}/v2/{configs.REGISTRY_NAMESPACE}/{image_name}"
+
+MANIFEST_ACCEPT = "application/vnd.docker.distribution.manifest.v2+json"
+
+
+class UpstreamSession:
+    """
+    Token handling for one repository on the registry.
+
+    Authentication is deferred until a request actually has to go upstream,
+    a pull served entirely by mirrors never talks to the registry.
+
+    Args:
+        timeout: Seconds the registry may stay silent on any request,
+                 configs.UPSTREAM_TIMEOUT by default.
+    """
+    def __init__(self, image_name: str, registry: str = None, timeout: float = None):
+        self.image_name = image_name
+        self.registry = registry or configs.REGISTRY_URL
+        self.timeout = configs.UPSTREAM_TIMEOUT if timeout is None else timeout
+        self.repo_url = repository_url(image_name, self.registry)
+        self._lock = threading.Lock()
+        self._token, self._scheme = load_session(self.registry)
+
+    def auth_header(self, refresh: bool = False) -> dict:
+        with self._lock:
+            if refresh or self._token is None:
+                self._token, self._scheme = auth_docker(f"{self.repo_url}/manifests/latest", self.registry,
+                                                        self.timeout)
+            return auth_headers(self._token, self._scheme)
+
+    def get(self, path: str, headers: dict = None, **kwargs) -> requests.Response:
+        """GET `path` (relative to the repository URL), re-authenticating once on a 401."""
+        url = f"{self.repo_url}{path}"
+        kwargs.setdefault("timeout", self.timeout)
+        rsp = requests.get(url, headers={**(headers or {}), **self.auth_header()}, **kwargs)
+        if rsp.status_code == 401:
+            log.debug("Request to %s was refused, re-authenticating: %s", url, rsp.text)
+            rsp = requests.get(url, headers={**(headers or {}), **self.auth_header(refresh=True)}, **kwargs)
+        return rsp
+
+
+def mirror_timeout() -> tuple:
+    """
+    (connect, read) timeout for peer mirrors.
+
+    A blob cache sends nothing until its own upstream fetch of a miss is done,
+    which may take as long as its followers wait for it, so only connecting
+    has to be quick.
+    """
+    return configs.MIRROR_TIMEOUT, configs.UPSTREAM_TIMEOUT + configs.BLOB_CACHE_WAIT
+
+
+def fetch_blob(upstream: UpstreamSession, digest: str, mirrors: list = (), blob_dir=None) -> Path:
+    """
+    Returns the verified blob `digest` from the blob dir (LAYER_BLOB_PATH by
+    default), downloading it from the first mirror that has it or from the
+    registry.
+
+    Mirrors get no Authorization header, registry tokens stay on this node.
+    """
+    blob_dir = blob_dir or configs.LAYER_BLOB_PATH
+    blob_path = Path(blob_dir)/digest
+    if blob_path.exists():
+        return blob_path
+    for mirror in mirrors:
+        blob_url = f"{repository_url(upstream.image_name, mirror)}/blobs/{digest}"
+        try:
+            return download_layer(blob_url, digest, {}, blob_dir, timeout=mirror_timeout())
+        except (requests.RequestException, ValueError) as e:
+            log.info("Mirror %s could not serve %s: %s", mirror, digest, e)
+    blob_url = f"{upstream.repo_url}/blobs/{digest}"
+    try:
+        return download_layer(blob_url, digest, upstream.auth_header(), blob_dir, timeout=upstream.timeout)
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 401:
+            raise
+        # The cached token expired and no manifest request upstream has refreshed it yet.
+        return download_layer(blob_url, digest, upstream.auth_header(refresh=True), blob_dir,
+                              timeout=upstream.timeout)
+
+
+def fetch_manifest(upstream: UpstreamSession, tag: str, mirrors: list = ()) -> bytes:
+    """Returns the raw manifest (or index) `tag` points to, from a mirror or the registry."""
+    for mirror in mirrors:
+        url = f"{repository_url(upstream.image_name, mirror)}/manifests/{tag}"
+        try:
+            rsp = requests.get(url, headers={"Accept": MANIFEST_ACCEPT}, timeout=mirror_timeout())
+        except requests.RequestException as e:
+            log.info("Mirror %s is unreachable: %s", mirror, e)
+            continue
+        if rsp.ok:
+            return rsp.content
+        log.debug("Mirror %s has no %s:%s (%s)", mirror, upstream.image_name, tag, rsp.status_code)
+
+    rsp = upstream.get(f"/manifests/{tag}", {"Accept": MANIFEST_ACCEPT})
+    rsp.raise_for_status()
+    return rsp.content
+
+
+def save_tag(image_name: str, tag: str, digest: str, image_dir=None):
+    """Records which manifest digest `image_name:tag` resolved to, for serving it to peers."""
+    tags_dir = Path(image_dir or configs.LOCAL_IMAGE_REGISTRY)/image_name/"tags"
+    tags_dir.mkdir(parents=True, exist_ok=True)
+    (tags_dir/tag).write_text(digest)
+
+
+def _extracted_marker(digest: str) -> Path:
+    """Marker written once the layer blob `digest` is fully extracted, it holds the layer's diff_id."""
+    return Path(configs.EXTRACTED_LAYERS_PATH)/".extracted"/digest.replace(":", "_")
+
+
+def fetch_layer(upstream: UpstreamSession, layer: dict, mirrors: list = (), dedup_stats: list = None):
+    """
+    Downloads one layer blob if it is not cached yet and extracts it by its diff_id.
+
+    Layers already extracted from the same blob digest are left as they are.
+
+    Args:
+        dedup_stats: Collects the DedupStats dict of the layer when it is
+                     extracted with LAYER_DEDUP on.
+    """
+    marker = _extracted_marker(layer['digest'])
+    if marker.exists():
+        dest_dir = Path(configs.EXTRACTED_LAYERS_PATH) / marker.read_text()
+        if dest_dir.is_dir():
+            log.info("Layer %s already extracted to: %s", layer['digest'], dest_dir)
+            return dest_dir
+
+    blob_path = fetch_blob(upstream, layer['digest'], mirrors)
+
+    decompressed_hash = sha256_of_tgz_stream(blob_path)
+    dest_dir = Path(configs.EXTRACTED_LAYERS_PATH) / decompressed_hash
+    if configs.LAYER_DEDUP != "off":
+        from app import dedup
+        stats = dedup.extract_layer(blob_path, dest_dir)
+        if dedup_stats is not None:
+            dedup_stats.append(stats)
+    else:
+        extract_layer(blob_path, dest_dir)
+    marker.parent.mkdir(parents=True, exist_ok=True)
+    tmp = marker.with_suffix(".tmp")
+    tmp.write_text(decompressed_hash)
+    os.replace(tmp, marker)
+    log.info("Extracted layer to: %s", dest_dir)
+    return dest_dir
+
+@tracing.traced("pull.docker_pull")
+def docker_pull(image, dest_dir, registry: str = None, max_workers: int = None,
+                mirrors: list = None, dedup_stats: list = None):
+    """
+    Pulls `image` (name:tag) and extracts its layers.
+
+    Args:
+        registry: Registry base URL, defaults to configs.REGISTRY_URL.
+        max_workers: Number of layers downloaded and extracted at the same
+                     time, defaults to configs.PULL_CONCURRENCY.
+        mirrors: Base URLs of peer blob caches (`python3 -m app.blob_cache`)
+                 tried in order before the registry, defaults to configs.PEER_MIRRORS.
+        dedup_stats: Collects the DedupStats dict of every layer extracted
+                     with LAYER_DEDUP on, see dedup.summarize().
+    """
+    max_workers = configs.PULL_CONCURRENCY if max_workers is None else max_workers
+    mirrors = configs.PEER_MIRRORS if mirrors is None else mirrors
     image_name = image.split(':')[0]
     image_tag = image.split(':')[1]
-    print(image_name, image_tag)
-    with open(SESSION_DATA_PATH, "r") as f:
-        session_data = json.load(f)
-    pull_url = f"https://registry-1.docker.io/v2/library/{image_name}/manifests/{image_tag}"
-    if not session_data.get("token"):
-        auth_docker(pull_url)
-    else:
-        token, token_scheme = session_data["token"], session_data["scheme"]
+    log.info("Pulling %s:%s", image_name, image_tag)
+    upstream = UpstreamSession(image_name, registry)
 
-    manifest_rsp = requests.get(pull_url, headers={"Accept": "application/vnd.docker.distribution.manifest.v2+json", "Authorization": f"{token_scheme} {token}"})
-    if not manifest_rsp.ok and manifest_rsp.status_code == 401:
-        print(manifest_rsp.text)
-        token, token_scheme = auth_docker(pull_url)
-        manifest_rsp = requests.get(pull_url, headers={"Accept": "application/vnd.docker.distribution.manifest.v2+json", "Authorization": f"{token_scheme} {token}"})
-        
-    manifest_data = manifest_rsp.json()
-    manifests_dir = f"{LOCAL_IMAGE_REGISTRY}/{image_name}/manifests"
+    with tracing.span("pull.fetch_manifest", tag=image_tag):
+        manifest_raw = fetch_manifest(upstream, image_tag, mirrors)
+    # Kept by digest next to the layers so this node can serve the image to its peers.
+    save_tag(image_name, image_tag, cache_blob(manifest_raw))
+
+    manifest_data = json.loads(manifest_raw)
+    manifests_dir = f"{configs.LOCAL_IMAGE_REGISTRY}/{image_name}/manifests"
     os.makedirs(manifests_dir, exist_ok=True)
     if not (Path(manifests_dir)/"base_manifest.json").exists():
         with open(Path(manifests_dir)/"base_manifest.json", "w") as f:
             json.dump(manifest_data, f)
 
-    print(manifest_data)
-    layer_list = []
+    log.debug("Image index: %s", manifest_data)
     for m in manifest_data["manifests"]:
         if m['platform']['os'] != 'linux' or m['platform']['architecture'] != 'amd64':
             continue
-        manifest_url = f"https://registry-1.docker.io/v2/library/{image_name}/blobs/{m['digest']}"
-        digest_data = requests.get(manifest_url, headers={"Accept": "application/vnd.docker.distribution.manifest.v2+json", "Authorization": f"{token_scheme} {token}"}).json()
+        with tracing.span("pull.fetch_manifest", digest=m['digest']):
+            digest_data = json.loads(fetch_blob(upstream, m['digest'], mirrors).read_bytes())
         if not (Path(manifests_dir)/"arch_manifest.json").exists():
             with open(Path(manifests_dir)/"arch_manifest.json", "w") as f:
                 json.dump(digest_data, f)
 
-        for l in digest_data['layers']:
-            blob_path = Path(LAYER_BLOB_PATH) / l['digest']
-            if not blob_path.exists():
-                blob_url = f"https://registry-1.docker.io/v2/library/{image_name}/blobs/{l['digest']}"
-                blob_path = download_layer(blob_url, l['digest'], {"Authorization": f"{token_scheme} {token}"}, LAYER_BLOB_PATH)
-
-            decompressed_hash = sha256_of_tgz_stream(blob_path)
-            dest_dir = Path(EXTRACTED_LAYERS_PATH) / decompressed_hash
-            extract_layer(blob_path, dest_dir)
-            print(f"Extracted layer to: {dest_dir}")
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            # list() re-raises the first failed layer here
+            list(pool.map(tracing.with_current_span(lambda l: fetch_layer(upstream, l, mirrors, dedup_stats)),
+                          digest_data['layers']))
             
-        config_manifest_url = f"https://registry-1.docker.io/v2/library/{image_name}/blobs/{digest_data['config']['digest']}"
-        config_manifest_data = requests.get(config_manifest_url, headers={"Authorization": f"{token_scheme} {token}"}).json()
+        config_manifest_data = json.loads(fetch_blob(upstream, digest_data['config']['digest'], mirrors).read_bytes())
         
         if not (Path(manifests_dir)/"config_manifest.json").exists():
-            print("[*] Creating the config manifest data...")
+            log.debug("[*] Creating the config manifest data...")
             with open(Path(manifests_dir)/"config_manifest.json","w") as f:
                 json.dump(config_manifest_data, f)
         
@@ -142,12 +403,13 @@ def docker_run(dest_dir: str, image_dir: Path):
     extract_dir.mkdir(parents=True, exist_ok=True)
     layer_list = os.listdir(image_dir)
     for l in layer_list:
-        print(image_dir, extract_dir)
+        log.debug("%s %s", image_dir, extract_dir)
 
 
 
 
 
 if __name__ == "__main__":
+    tracing.configure_logging()
     image_with_tag = sys.argv[1]
-    docker_pull(image_with_tag, LOCAL_IMAGE_REGISTRY)
\ No newline at end of file
+    docker_pull(image_with_tag, configs.LOCAL_IMAGE_REGISTRY)
\ No newline at end of file
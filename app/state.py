@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import uuid
+from pathlib import Path
+from app import configs
+
+
+def _state_file(container_id: str) -> Path:
+    return Path(configs.CONTAINER_STATE_PATH)/f"{container_id}.json"
+
+
+def new_container_id(image: str) -> str:
+    """A fresh container id, e.g. alpine_latest-1f2e3."""
+    return image.replace(':', '_').replace('/', '_') + "-" + uuid.uuid4().hex[:5]
+
+
+def process_start_time(pid: int) -> int:
+    """Start time of `pid` in clock ticks since boot, which tells it apart from a later process reusing the pid."""
+    with open(f"/proc/{pid}/stat", "rb") as f:
+        stat = f.read()
+    # comm (field 2) may contain spaces and parentheses, count from the last ')'.
+    return int(stat[stat.rindex(b")") + 2:].split()[19])
+
+
+def register_container(container_id: str, pid: int, image: str, cgroup_path=None, volumes: list = ()):
+    """Records a running container so other commands (logs, exec, volume rm) can find it."""
+    Path(configs.CONTAINER_STATE_PATH).mkdir(parents=True, exist_ok=True)
+    state = {"id": container_id, "pid": pid, "pid_start_time": process_start_time(pid), "image": image,
+             "cgroup": str(cgroup_path) if cgroup_path else None, "volumes": list(volumes),
+             "started": time.time()}
+    tmp = _state_file(container_id).with_suffix(".tmp")
+    tmp.write_text(json.dumps(state))
+    os.replace(tmp, _state_file(container_id))
+
+
+def unregister_container(container_id: str):
+    _state_file(container_id).unlink(missing_ok=True)
+
+
+def is_running(info: dict) -> bool:
+    """Whether the process recorded for a container is still the one that registered it."""
+    try:
+        return process_start_time(info["pid"]) == info.get("pid_start_time")
+    except (OSError, ValueError, IndexError):
+        return False
+
+
+def list_containers() -> list:
+    """States of all registered containers, oldest first."""
+    infos = []
+    for path in Path(configs.CONTAINER_STATE_PATH).glob("*.json"):
+        try:
+            infos.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue # unregistered while we were reading it
+    return sorted(infos, key=lambda info: info.get("started", 0))
+
+
+def containers_using_volume(volume: str) -> list:
+    """Ids of the running containers that have the named volume mounted."""
+    return [info["id"] for info in list_containers()
+            if volume in info.get("volumes", ()) and is_running(info)]
+
+
+def load_container(name: str) -> dict:
+    """
+    Returns the state of a running container by id or unique id prefix.
+
+    Raises LookupError when nothing, or more than one container, matches.
+    """
+    exact = _state_file(name)
+    if exact.exists():
+        return json.loads(exact.read_text())
+    matches = list(Path(configs.CONTAINER_STATE_PATH).glob(f"{name}*.json"))
+    if len(matches) != 1:
+        raise LookupError(f"No such container: {name}" if not matches else f"Ambiguous container id: {name}")
+    return json.loads(matches[0].read_text())
@@ -0,0 +1,332 @@
+"""
+Per-container storage: where the overlay upperdir lives, named volumes and
+scratch tmpfs mounts.
+
+With the "tmpfs" storage mode the upperdir and workdir sit on a size-capped
+tmpfs instead of under CONTAINER_RUNTIME_ROOT_DIR, so a write-heavy job's
+scratch writes never reach the disk and nothing is left behind to clean up.
+These mounts are made inside the container's own mount namespace by a
+helper that has joined the container's cgroup first. They disappear
+together with the namespace when the container exits. tmpfs pages are
+charged to the memory cgroup of the process that writes them, so they
+count against the container's memory.max along with its other memory.
+
+Named volumes are bind mounts of VOLUMES_PATH/<name>/data. The data dir is
+a plain directory, a tmpfs, or an ext4 filesystem on a pre-allocated
+backing file, which reserves the volume's blocks when it is created.
+"""
+import os
+import sys
+import json
+import fcntl
+import errno
+import struct
+import shutil
+import logging
+from pathlib import Path
+from app import configs, libc, tracing
+from app.host_prep import create_overlay_filesystem
+from app.constants import COMMON_LIBC_FLAGS as uflags
+
+log = logging.getLogger(__name__)
+
+# Host ids of the container's root, matching the uid_map ProcessMananger writes.
+CONTAINER_ROOT_UID = 1000
+CONTAINER_ROOT_GID = 1000
+BACKENDS = ("dir", "tmpfs", "file")
+MAX_SYMLINKS = 40 # Same limit as the kernel's path walk (ELOOP)
+
+LOOP_CTL_GET_FREE = 0x4C82
+LOOP_SET_FD = 0x4C00
+LOOP_SET_STATUS64 = 0x4C04
+LO_FLAGS_AUTOCLEAR = 4 # Detach the loop device once its filesystem is unmounted
+LOOP_INFO64_SIZE = 232
+LOOP_INFO64_FLAGS_OFFSET = 52
+
+
+def parse_size(size) -> int:
+    """Parses "64MB", "64m" or a plain byte count into bytes."""
+    if isinstance(size, int):
+        return size
+    amount = "".join(c for c in size.lower() if c.isdigit())
+    unit = "".join(c for c in size.lower() if not c.isdigit())
+    if not amount:
+        raise ValueError(f"Invalid size: {size}")
+    if not unit:
+        return int(amount)
+    unit = unit if unit.endswith("b") else unit + "b"
+    try:
+        return int(amount) * configs.MEM_UNIT_MAP[unit]
+    except KeyError:
+        raise ValueError(f"Invalid size unit: {size}") from None
+
+
+def _tmpfs_options(size: int, mode: str = "0755") -> str:
+    return f"size={size},mode={mode},uid={CONTAINER_ROOT_UID},gid={CONTAINER_ROOT_GID}"
+
+
+def _check_target(target: str) -> str:
+    if not target.startswith("/") or ".." in Path(target).parts:
+        raise ValueError(f"Mount target must be an absolute path without '..': {target}")
+    return target
+
+
+def _inside_root(root, target: str) -> Path:
+    """
+    Creates `target` under the container's root and returns it.
+
+    This runs as host root, so symlinks in the image are resolved by hand the
+    way the container will see them: absolute links start over at the
+    container root and `..` stops there, instead of reaching the host's.
+    """
+    root = Path(root)
+    resolved = [] # components below root, none of them a symlink
+    pending = target.split("/")
+    links = 0
+    while pending:
+        part = pending.pop(0)
+        if part in ("", "."):
+            continue
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+        path = root.joinpath(*resolved, part)
+        if path.is_symlink():
+            links += 1
+            if links > MAX_SYMLINKS:
+                raise ValueError(f"Too many levels of symbolic links in mount target: {target}")
+            link = os.readlink(path)
+            if link.startswith("/"):
+                resolved = []
+            pending[:0] = link.split("/")
+            continue
+        resolved.append(part)
+    path = root.joinpath(*resolved)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def prepare_mountpoints(runtime_dir):
+    """Creates and hands over the dirs pivot_root and the DNS bind mount need."""
+    runtime_dir = Path(runtime_dir)
+    for d in (runtime_dir/"old_root", runtime_dir/"etc", runtime_dir/"sys"):
+        d.mkdir(parents=True, exist_ok=True)
+    (runtime_dir/"etc"/"resolv.conf").touch()
+    os.chown(runtime_dir, CONTAINER_ROOT_UID, CONTAINER_ROOT_GID)
+    os.chown(runtime_dir/"old_root", CONTAINER_ROOT_UID, CONTAINER_ROOT_GID)
+
+
+def _mount_loop(backing_file: Path, target: Path, fstype: str, flags: int = 0):
+    """Mounts the filesystem in `backing_file` at `target` through a free loop device."""
+    with open("/dev/loop-control", "rb") as ctl:
+        number = fcntl.ioctl(ctl, LOOP_CTL_GET_FREE)
+    device = f"/dev/loop{number}"
+    with open(backing_file, "r+b") as backing, open(device, "r+b") as loop:
+        fcntl.ioctl(loop, LOOP_SET_FD, backing.fileno())
+        info = bytearray(LOOP_INFO64_SIZE)
+        struct.pack_into("I", info, LOOP_INFO64_FLAGS_OFFSET, LO_FLAGS_AUTOCLEAR)
+        fcntl.ioctl(loop, LOOP_SET_STATUS64, bytes(info))
+        # With autoclear the device detaches when its last user goes, mount before closing it.
+        libc.mount(device, target, fstype, flags, None)
+
+
+class Volume:
+    """
+    A named volume mounted at `target` inside the container.
+
+    Args:
+        backend: "dir", "tmpfs" or "file" (ext4 on a pre-allocated file).
+        size: Size cap in bytes, required for "file", TMPFS_SCRATCH_SIZE
+              for "tmpfs" when not given.
+    """
+    def __init__(self, name: str, target: str, backend: str = "dir", size: int = None):
+        if not name or "/" in name or name.startswith("."):
+            raise ValueError(f"Invalid volume name: {name}")
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown volume backend: {backend}")
+        if backend == "file" and not size:
+            raise ValueError(f"Volume {name}: a file backed volume needs a size")
+        self.name = name
+        self.target = _check_target(target)
+        self.backend = backend
+        self.size = size
+        self.root = Path(configs.VOLUMES_PATH)/name
+        self.data_dir = self.root/"data"
+
+    @classmethod
+    def parse(cls, spec: str) -> "Volume":
+        """Parses `name:/path`, `name:/path:tmpfs[=SIZE]` or `name:/path:file=SIZE`."""
+        parts = spec.split(":")
+        if len(parts) not in (2, 3):
+            raise ValueError(f"Invalid volume spec: {spec}")
+        backend, _, size = (parts[2] if len(parts) == 3 else "dir").partition("=")
+        return cls(parts[0], parts[1], backend, parse_size(size) if size else None)
+
+    def _metadata(self) -> dict:
+        return {"backend": self.backend, "size": self.size}
+
+    @tracing.traced("storage.prepare_volume")
+    def prepare(self) -> Path:
+        """
+        Creates the volume on first use, or remounts its backing store after
+        a reboot, and returns the host dir to bind mount.
+        """
+        meta_path = self.root/"volume.json"
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            if meta["backend"] != self.backend:
+                raise ValueError(f"Volume {self.name} already exists with the {meta['backend']} backend")
+            self.size = meta["size"]
+        else:
+            self.data_dir.mkdir(parents=True, exist_ok=True)
+            if self.backend == "file":
+                self._create_backing_file()
+            meta_path.write_text(json.dumps(self._metadata()))
+            log.info("[+] Created %s volume %s", self.backend, self.name)
+
+        if self.backend != "dir" and not os.path.ismount(self.data_dir):
+            self._mount_backing()
+        if self.backend != "tmpfs":
+            # tmpfs gets its owner from the mount options
+            os.chown(self.data_dir, CONTAINER_ROOT_UID, CONTAINER_ROOT_GID)
+        return self.data_dir
+
+    def _create_backing_file(self):
+        backing = self.root/"backing.img"
+        fd = os.open(backing, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            # Reserves the blocks now, the volume cannot run the host disk out of space later.
+            os.posix_fallocate(fd, 0, self.size)
+        finally:
+            os.close(fd)
+        import subprocess
+        subprocess.run(["mkfs.ext4", "-q", "-F", "-m", "0", str(backing)], check=True)
+
+    def _mount_backing(self):
+        if self.backend == "tmpfs":
+            size = self.size or parse_size(configs.TMPFS_SCRATCH_SIZE)
+            libc.mount("tmpfs", self.data_dir, "tmpfs", uflags.MS_NOSUID | uflags.MS_NODEV, _tmpfs_options(size))
+        else:
+            _mount_loop(self.root/"backing.img", self.data_dir, "ext4", uflags.MS_NOSUID | uflags.MS_NODEV)
+        log.debug("[+] Mounted %s backing store of volume %s", self.backend, self.name)
+
+    def remove(self, force: bool = False):
+        """
+        Deletes the volume and its data.
+
+        Raises:
+            OSError: EBUSY when a running container has it mounted, unless `force`.
+        """
+        from app import state
+        users = state.containers_using_volume(self.name)
+        if users and not force:
+            raise OSError(errno.EBUSY, f"Volume {self.name} is in use by {', '.join(users)}")
+        if os.path.ismount(self.data_dir):
+            libc.umount2(self.data_dir, libc.MNT_DETACH)
+        shutil.rmtree(self.root)
+
+
+class ContainerStorage:
+    """
+    Storage settings of one container.
+
+    Args:
+        rootfs: "disk" or "tmpfs", defaults to configs.CONTAINER_STORAGE.
+        rootfs_size: Size cap of the tmpfs upperdir in bytes.
+        volumes: Named Volumes to bind mount.
+        scratch: (target, size in bytes) of anonymous tmpfs mounts that only
+                 live as long as the container.
+    """
+    def __init__(self, rootfs: str = None, rootfs_size: int = None, volumes: list = None, scratch: list = None):
+        self.rootfs = rootfs or configs.CONTAINER_STORAGE
+        if self.rootfs not in ("disk", "tmpfs"):
+            raise ValueError(f"Unknown storage mode: {self.rootfs}")
+        self.rootfs_size = rootfs_size or parse_size(configs.TMPFS_ROOTFS_SIZE)
+        self.volumes = volumes or []
+        self.scratch = [(_check_target(target), size) for target, size in scratch or []]
+        # Set by host_prep.setup_filesystem, mounted by the helper in tmpfs mode.
+        self.lowerdirs = []
+        self._sources = []
+
+    @property
+    def needs_mounts(self) -> bool:
+        """False for a plain disk container, which then starts without the mount helper."""
+        return self.rootfs == "tmpfs" or bool(self.volumes or self.scratch)
+
+    def prepare_host(self):
+        """Creates the volumes on the host. Runs before the container is forked."""
+        self._sources = [(volume.prepare(), volume.target) for volume in self.volumes]
+
+    def _mount_all(self, runtime_dir: Path):
+        if self.rootfs == "tmpfs":
+            overlay_dir = runtime_dir.parent/"overlay"
+            libc.mount("tmpfs", overlay_dir, "tmpfs", uflags.MS_NOSUID | uflags.MS_NODEV,
+                       f"size={self.rootfs_size},mode=0700")
+            (overlay_dir/"upperdir").mkdir()
+            (overlay_dir/"workdir").mkdir()
+            create_overlay_filesystem(self.lowerdirs, str(overlay_dir/"upperdir"), str(overlay_dir/"workdir"),
+                                      str(runtime_dir))
+            prepare_mountpoints(runtime_dir)
+        for source, target in self._sources:
+            libc.mount(source, _inside_root(runtime_dir, target), None, uflags.MS_BIND, None)
+        for target, size in self.scratch:
+            libc.mount("tmpfs", _inside_root(runtime_dir, target), "tmpfs", uflags.MS_NOSUID | uflags.MS_NODEV,
+                       _tmpfs_options(size, "1777"))
+
+    @tracing.traced("storage.mount_into")
+    def mount_into(self, pid: int, runtime_dir, cgroup_path=None):
+        """
+        Mounts the container's storage inside the mount namespace of `pid`.
+
+        A forked helper joins the container's cgroup, so the tmpfs memory it
+        sets up is charged there, then the container's mount namespace, and
+        mounts. The mounts go away with the namespace. Must run before the
+        container is released to pivot_root.
+        """
+        ns_fd = os.open(f"/proc/{pid}/ns/mnt", os.O_RDONLY | os.O_CLOEXEC)
+        helper = os.fork()
+        if helper == 0:
+            code = 1
+            try:
+                if cgroup_path is not None:
+                    (Path(cgroup_path)/"cgroup.procs").write_text("0")
+                libc.setns(ns_fd, uflags.CLONE_NEWNS)
+                self._mount_all(Path(runtime_dir))
+                code = 0
+            except BaseException as e:
+                log.error("[Helper] Mounting storage for %s failed: %s", pid, e)
+            finally:
+                tracing.flush()
+                os._exit(code)
+        os.close(ns_fd)
+        _, status = os.waitpid(helper, 0)
+        if os.waitstatus_to_exitcode(status) != 0:
+            raise OSError(errno.EIO, f"Could not mount the storage of container process {pid}")
+
+
+def main(argv: list):
+    """Entry point for `volume ls` and `volume rm [-f] <name>...`."""
+    if argv[:1] == ["ls"]:
+        for meta_path in sorted(Path(configs.VOLUMES_PATH).glob("*/volume.json")):
+            meta = json.loads(meta_path.read_text())
+            size = f"{meta['size'] / 1024**2:.0f}MiB" if meta["size"] else "-"
+            print(f"{meta_path.parent.name}\t{meta['backend']}\t{size}")
+    elif argv[:1] == ["rm"] and [arg for arg in argv[1:] if arg not in ("-f", "--force")]:
+        force = "-f" in argv or "--force" in argv
+        for name in argv[1:]:
+            if name in ("-f", "--force"):
+                continue
+            meta_path = Path(configs.VOLUMES_PATH)/name/"volume.json"
+            if not meta_path.exists():
+                print(f"Error: No such volume: {name}", file=sys.stderr)
+                sys.exit(1)
+            meta = json.loads(meta_path.read_text())
+            try:
+                Volume(name, "/", meta["backend"], meta["size"]).remove(force)
+            except OSError as e:
+                print(f"Error: {e.strerror}, stop it first or pass --force", file=sys.stderr)
+                sys.exit(1)
+    else:
+        print("Usage: volume ls | volume rm [-f|--force] <name>...", file=sys.stderr)
+        sys.exit(1)
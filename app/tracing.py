@@ -0,0 +1,290 @@
+"""
+Lightweight tracing and diagnostics for the runtime.
+
+Timed, nested spans and counters (syscalls, netlink messages) are written as
+JSON lines or in the Chrome trace event format (load it in chrome://tracing
+or Perfetto). Tracing is off unless PUNCKER_TRACE points at an output file or
+enable() is called. While it is off, span() hands back a shared no-op object
+and count() returns immediately, so instrumented hot paths pay a single
+global lookup.
+
+    PUNCKER_TRACE=/tmp/run.trace PUNCKER_TRACE_FORMAT=chrome ./your_docker.sh run ...
+
+Forked children keep tracing into the same file. Processes that leave through
+os._exit() or exec must call flush() first.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import itertools
+import functools
+import threading
+import contextvars
+
+
+LOG_LEVEL_ENV = "PUNCKER_LOG_LEVEL"
+TRACE_ENV = "PUNCKER_TRACE"
+TRACE_FORMAT_ENV = "PUNCKER_TRACE_FORMAT"
+FLUSH_EVERY = 1024 # Buffered events before they are written out
+
+_tracer = None
+# The innermost open span. A context variable rather than a thread local, so
+# with_current_span() can hand it to worker threads.
+_current_span = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    __slots__ = ("tracer", "name", "attrs", "start_ns", "parent", "id", "_token")
+
+    def __init__(self, tracer: "Tracer", name: str, attrs: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.start_ns = 0
+        self.parent = None
+        # Unique across the supervisor and its forked children.
+        self.id = f"{os.getpid()}.{next(_span_ids)}"
+        self._token = None
+
+    def set(self, **attrs):
+        """Attaches extra attributes, e.g. a size only known at the end."""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        self._token = _current_span.set(self)
+        self.start_ns = time.monotonic_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.monotonic_ns() - self.start_ns
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer._record(self, duration)
+        return False
+
+
+class Tracer:
+    """Collects spans and counters and appends them to `path`."""
+    def __init__(self, path: str, fmt: str = "jsonl"):
+        if fmt not in ("jsonl", "chrome"):
+            raise ValueError(f"Unknown trace format: {fmt}")
+        self.path = path
+        self.fmt = fmt
+        # Opened once: forked children inherit it and can still write after pivot_root.
+        # O_APPEND keeps writes from the supervisor and its children whole.
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC, 0o644)
+        self.counters = {}
+        self._events = []
+        self._lock = threading.Lock()
+
+    def span(self, name: str, attrs: dict) -> Span:
+        return Span(self, name, attrs)
+
+    def count(self, name: str, n: int):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _record(self, span: Span, duration_ns: int):
+        pid, tid = os.getpid(), threading.get_native_id()
+        parent_id = span.parent.id if span.parent else None
+        if self.fmt == "chrome":
+            event = {"name": span.name, "cat": span.name.split(".")[0], "ph": "X",
+                     "ts": span.start_ns / 1000, "dur": duration_ns / 1000, "pid": pid, "tid": tid,
+                     "args": {**span.attrs, "span_id": span.id, "parent_id": parent_id}}
+        else:
+            event = {"type": "span", "name": span.name, "id": span.id, "parent_id": parent_id,
+                     "parent": span.parent.name if span.parent else None,
+                     "start_ns": span.start_ns, "duration_ns": duration_ns,
+                     "pid": pid, "tid": tid, "attrs": span.attrs}
+        with self._lock:
+            self._events.append(event)
+            full = len(self._events) >= FLUSH_EVERY
+        if full:
+            self.flush()
+
+    def _counter_event(self) -> dict:
+        if self.fmt == "chrome":
+            return {"name": "counters", "ph": "C", "ts": time.monotonic_ns() / 1000,
+                    "pid": os.getpid(), "args": dict(self.counters)}
+        return {"type": "counters", "pid": os.getpid(), "ts_ns": time.monotonic_ns(),
+                "counters": dict(self.counters)}
+
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, []
+            if self.counters:
+                events.append(self._counter_event())
+            if not events:
+                return
+            lines = "".join(json.dumps(e, default=str) + ("," if self.fmt == "chrome" else "") + "\n"
+                            for e in events)
+            if self.fmt == "chrome" and os.fstat(self._fd).st_size == 0:
+                # The trace event format allows leaving the array unterminated.
+                lines = "[\n" + lines
+            os.write(self._fd, lines.encode())
+
+    def close(self):
+        self.flush()
+        os.close(self._fd)
+
+    def _after_fork_in_child(self):
+        # The parent still owns whatever was buffered before the fork.
+        self._events = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+
+def enable(path: str, fmt: str = "jsonl") -> Tracer:
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = Tracer(path, fmt)
+    return _tracer
+
+
+def disable():
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = None
+
+
+def is_enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, **attrs):
+    """
+    Times the enclosed block as `name`.
+
+        with tracing.span("pull.download_layer", digest=digest):
+            ...
+    """
+    if _tracer is None:
+        return _NOOP_SPAN
+    return _tracer.span(name, attrs)
+
+
+def traced(name: str):
+    """Decorator form of span() for whole functions."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return fn(*args, **kwargs)
+            with _tracer.span(name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def with_current_span(fn):
+    """
+    Wraps `fn` so spans it opens nest under the span open right now, even
+    when it runs on a worker thread:
+
+        pool.map(tracing.with_current_span(fetch_layer), layers)
+    """
+    parent = _current_span.get()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _current_span.set(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+    return wrapper
+
+
+def count(name: str, n: int = 1):
+    """Bumps counter `name`, e.g. count("syscall.mount")."""
+    if _tracer is not None:
+        _tracer.count(name, n)
+
+
+def flush():
+    if _tracer is not None:
+        _tracer.flush()
+
+
+class _CallCounter:
+    """Proxy that counts every method call made through it as `<prefix>.<method>`."""
+    def __init__(self, target, prefix: str):
+        self._target = target
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            count(f"{self._prefix}.{name}")
+            count(f"{self._prefix}.messages")
+            return attr(*args, **kwargs)
+        return counted
+
+    def __enter__(self):
+        self._target.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._target.__exit__(*exc)
+
+
+def count_calls(target, prefix: str):
+    """
+    Wraps `target` (e.g. a pyroute2 socket) so its calls are counted.
+
+    Returns `target` untouched when tracing is off.
+    """
+    if _tracer is None:
+        return target
+    return _CallCounter(target, prefix)
+
+
+def configure_logging(level: str = None):
+    """
+    Sets up the runtime's leveled logging.
+
+    Defaults to WARNING so the progress messages on the start-up path cost
+    nothing unless PUNCKER_LOG_LEVEL (or `level`) asks for them.
+    """
+    level = (level or os.environ.get(LOG_LEVEL_ENV, "WARNING")).upper()
+    logging.basicConfig(level=getattr(logging, level, logging.WARNING), stream=sys.stderr,
+                        format="%(asctime)s %(levelname)s %(name)s[%(process)d]: %(message)s")
+
+
+def _after_fork_in_child():
+    if _tracer is not None:
+        _tracer._after_fork_in_child()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+atexit.register(flush)
+
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV], os.environ.get(TRACE_FORMAT_ENV, "jsonl"))
@@ -0,0 +1,74 @@
+"""
+Startup budget check for the CLI entry point.
+
+Imports the modules a `run` of an already pulled image loads under
+`python -X importtime` and fails (exit 1) when their cumulative import time
+goes over budget or when a module that only `pull` or networking needs gets
+loaded on that path.
+
+Usage:
+    python3 -m benchmarks.import_time --budget-ms 40
+"""
+import os
+import re
+import sys
+import argparse
+import subprocess
+from pathlib import Path
+
+
+# Deferred until a pull or a networked container actually needs them.
+FORBIDDEN = ("requests", "pyroute2", "tarfile", "gzip", "hashlib", "urllib3")
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+REPO_ROOT = Path(__file__).resolve().parent.parent
+LAUNCH_PATH = "app.main,app.cgroups,app.host_prep,app.processes"
+
+
+def measure(modules: str = LAUNCH_PATH, runs: int = 5) -> tuple:
+    """
+    Returns (best cumulative microseconds for `modules`, every module imported).
+
+    The best of several runs is used, the first run mostly measures a cold
+    page cache.
+    """
+    best, imported = None, set()
+    env = {**os.environ, "PYTHONPATH": str(REPO_ROOT), "PYTHONDONTWRITEBYTECODE": ""}
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {modules}"],
+                              capture_output=True, text=True, env=env, check=True)
+        total = 0
+        for line in proc.stderr.splitlines():
+            match = IMPORT_LINE.match(line)
+            if not match:
+                continue
+            imported.add(match[4])
+            # Only top-level entries, nested ones are already in their parent's cumulative.
+            if len(match[3]) == 1 and match[4] in modules.split(","):
+                total += int(match[2])
+        best = total if best is None else min(best, total)
+    return best, imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CLI import time budget check")
+    parser.add_argument("--budget-ms", type=float, default=40.0)
+    parser.add_argument("--modules", default=LAUNCH_PATH, help="Comma separated modules to import")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    cumulative_us, imported = measure(args.modules, args.runs)
+    leaked = sorted({m.split(".")[0] for m in imported} & set(FORBIDDEN))
+    print(f"{args.modules}: {cumulative_us / 1000:.1f}ms cumulative (budget {args.budget_ms}ms)")
+
+    failed = False
+    if leaked:
+        print(f"FAIL: launch path imports {', '.join(leaked)}", file=sys.stderr)
+        failed = True
+    if cumulative_us / 1000 > args.budget_ms:
+        print("FAIL: over the startup budget", file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Pull throughput benchmark against the local registry stand-in.
+
+Generates a synthetic image, serves it from app.local_registry on loopback
+and times cold `docker_pull` runs for each concurrency setting. Reports MB/s
+(compressed blob bytes over wall time) and time-to-ready (until docker_pull
+returns with every layer extracted) as JSON.
+
+Usage:
+    python3 -m benchmarks.pull_throughput --layers 8 --layer-size 16 -c 1,2,4,8 -o pull.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+from pathlib import Path
+from app import configs
+from app.local_registry import LocalRegistry, generate_image
+from benchmarks.start_latency import percentile
+
+
+BENCH_IMAGE = "pullbench:latest"
+
+
+@contextlib.contextmanager
+def scratch_storage(base: Path):
+    """Points the pull storage paths at `base` for the duration of the block."""
+    names = ("LOCAL_IMAGE_REGISTRY", "SESSION_DATA_PATH", "LAYER_BLOB_PATH", "EXTRACTED_LAYERS_PATH")
+    saved = {name: getattr(configs, name) for name in names}
+    for name in names:
+        setattr(configs, name, str(base/name.lower()))
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(configs, name, value)
+
+
+def cold_pull(registry_url: str, workers: int, base: Path) -> float:
+    """One docker_pull with empty blob, layer and image caches. Returns seconds."""
+    from app.pull import docker_pull
+
+    shutil.rmtree(base, ignore_errors=True)
+    base.mkdir(parents=True)
+    with scratch_storage(base), open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.monotonic()
+        docker_pull(BENCH_IMAGE, configs.LOCAL_IMAGE_REGISTRY, registry=registry_url, max_workers=workers)
+        return time.monotonic() - start
+
+
+def run_benchmark(layers: int, layer_size: int, compression: str, concurrency: list, repeat: int,
+                  bandwidth: float = None, latency: float = 0.0, auth: bool = False) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)/"registry"
+        image = generate_image(root, BENCH_IMAGE, layers, layer_size, compression)
+        registry = LocalRegistry(root, bandwidth=bandwidth, latency=latency, require_auth=auth).start()
+        try:
+            results = {}
+            for workers in concurrency:
+                times = [cold_pull(registry.url, workers, Path(tmp)/"node") for _ in range(repeat)]
+                mb = image["layer_bytes"] / 1024**2
+                results[str(workers)] = {
+                    "time_to_ready_p50_s": percentile(times, 50),
+                    "time_to_ready_p95_s": percentile(times, 95),
+                    "mb_per_s_p50": mb / percentile(times, 50),
+                    "samples_s": times,
+                }
+        finally:
+            registry.stop()
+
+    return {
+        "image": image,
+        "compression": compression,
+        "layer_size": layer_size,
+        "bandwidth_bytes_per_s": bandwidth,
+        "latency_s": latency,
+        "auth": auth,
+        "repeat": repeat,
+        "timestamp": time.time(),
+        "concurrency": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="docker_pull throughput benchmark")
+    parser.add_argument("--layers", type=int, default=5)
+    parser.add_argument("--layer-size", type=float, default=8, help="MiB per layer, uncompressed")
+    parser.add_argument("--compression", choices=("gzip", "none"), default="gzip")
+    parser.add_argument("-c", "--concurrency", default="1,2,4", help="Comma separated worker counts")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("--bandwidth", type=float, help="Registry send limit in MiB/s")
+    parser.add_argument("--latency", type=float, default=0.0, help="Per-request latency in milliseconds")
+    parser.add_argument("--auth", action="store_true", help="Go through the token endpoint")
+    parser.add_argument("-o", "--output", help="Write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(args.layers, int(args.layer_size * 1024**2), args.compression,
+                           [int(c) for c in args.concurrency.split(",")], args.repeat,
+                           bandwidth=args.bandwidth * 1024**2 if args.bandwidth else None,
+                           latency=args.latency / 1000, auth=args.auth)
+    for workers, stats in result["concurrency"].items():
+        print(f"workers={workers:>3}  ready p50={stats['time_to_ready_p50_s']:.3f}s  "
+              f"{stats['mb_per_s_p50']:.1f} MB/s", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Container start latency benchmark.
+
+Runs N container starts, one after another and then `--concurrency` at a time,
+against an image that has already been pulled and extracted locally, and
+reports p50/p95/p99 for every start-up phase as JSON.
+
+Without root (or without netlink) the phases that need them are skipped and a
+bare fork/unshare/uid-map/exec start is measured instead.
+
+Usage:
+    python3 -m benchmarks.start_latency alpine:latest -n 50 -c 8 -o start.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import ctypes
+import argparse
+import platform
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from app import configs
+from app.constants import COMMON_LIBC_FLAGS as uflags
+
+
+PHASES = [
+    "pull_manifest",
+    "setup_filesystem",
+    "fork_unshare",
+    "uid_gid_map",
+    "mount_storage",
+    "setup_host_infrastructure",
+    "wire_container",
+    "pivot_root",
+    "exec_first_instruction",
+]
+
+
+def percentile(samples: list, pct: float) -> float:
+    """Nearest-rank percentile, fine for the sample counts we deal with."""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def summarize(runs: list) -> dict:
+    summary = {}
+    for phase in PHASES + ["total"]:
+        samples = [r[phase] for r in runs if phase in r]
+        if not samples:
+            continue
+        summary[phase] = {
+            "count": len(samples),
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+        }
+    return summary
+
+
+def detect_mode() -> str:
+    """Returns "full", "no-network" or "degraded" depending on what this host allows."""
+    if os.geteuid() != 0:
+        return "degraded"
+    try:
+        from pyroute2 import IPRoute
+        IPRoute().close()
+    except Exception:
+        return "no-network"
+    return "full"
+
+
+def time_manifest(image: str, pull: bool) -> float:
+    start = time.monotonic()
+    if pull:
+        from app.pull import docker_pull
+        docker_pull(image, configs.LOCAL_IMAGE_REGISTRY)
+    else:
+        manifest_path = Path(configs.LOCAL_IMAGE_REGISTRY)/image.split(':')[0]/"manifests"/"config_manifest.json"
+        with open(manifest_path) as f:
+            json.load(f)
+    return time.monotonic() - start
+
+
+def full_start(image: str, index: int, network: bool, pull: bool) -> dict:
+    """One real container start through setup_filesystem and ProcessMananger."""
+    from app import state
+    from app.host_prep import setup_filesystem, teardown_filesystem
+    from app.processes import ProcessMananger
+
+    container_id = state.new_container_id(image)
+    timings = {"pull_manifest": time_manifest(image, pull)}
+    start = time.monotonic()
+    try:
+        setup_filesystem(image, container_id)
+        timings["setup_filesystem"] = time.monotonic() - start
+
+        pm = ProcessMananger("echo ready", image,
+                             container_ip=f"172.16.7.{10 + index % 240}/24",
+                             veth_suffix=f"bn{index}",
+                             network=network, mirror_output=False, container_id=container_id)
+        pm.run()
+        timings.update(pm.timings)
+        timings["total"] = time.monotonic() - start + timings["pull_manifest"]
+    finally:
+        # Unmount and delete every sample's rootfs so they do not pile up.
+        teardown_filesystem(container_id)
+    return timings
+
+
+def degraded_start(image: str, index: int, pull: bool) -> dict:
+    """
+    fork + unprivileged user/mount/uts/ipc namespaces + uid map + exec.
+
+    No rootfs, network or pivot_root, those need privileges we do not have.
+    """
+    libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    timings = {}
+    try:
+        timings["pull_manifest"] = time_manifest(image, pull)
+    except FileNotFoundError:
+        pass # No local image, the namespace phases are still worth measuring
+
+    sig_rd, sig_wr = os.pipe()
+    go_rd, go_wr = os.pipe()
+    out_rd, out_wr = os.pipe()
+    uid, gid = os.getuid(), os.getgid()
+    start = time.monotonic()
+    child_pid = os.fork()
+    if child_pid == 0:
+        ret = libc.unshare(uflags.CLONE_NEWUSER | uflags.CLONE_NEWNS | uflags.CLONE_NEWUTS | uflags.CLONE_NEWIPC)
+        os.write(sig_wr, json.dumps({"unshared": time.monotonic(), "ok": ret == 0}).encode())
+        os.read(go_rd, 1)
+        os.dup2(out_wr, 1)
+        os.write(sig_wr, json.dumps({"exec": time.monotonic()}).encode())
+        try:
+            os.execvp("echo", ["echo", "ready"])
+        finally:
+            os._exit(127)
+
+    os.close(out_wr)
+    marks = json.loads(os.read(sig_rd, 4096))
+    timings["fork_unshare"] = marks["unshared"] - start
+    if marks["ok"]:
+        phase_start = time.monotonic()
+        with open(f"/proc/{child_pid}/setgroups", "w") as f:
+            f.write("deny")
+        with open(f"/proc/{child_pid}/gid_map", "w") as f:
+            f.write(f"0 {gid} 1\n")
+        with open(f"/proc/{child_pid}/uid_map", "w") as f:
+            f.write(f"0 {uid} 1\n")
+        timings["uid_gid_map"] = time.monotonic() - phase_start
+    os.write(go_wr, b"1")
+    exec_mark = json.loads(os.read(sig_rd, 4096))["exec"]
+    os.read(out_rd, 1)
+    timings["exec_first_instruction"] = time.monotonic() - exec_mark
+    os.waitpid(child_pid, 0)
+    timings["total"] = time.monotonic() - start + timings.get("pull_manifest", 0)
+
+    for fd in (sig_rd, sig_wr, go_rd, go_wr, out_rd):
+        os.close(fd)
+    return timings
+
+
+def one_start(image: str, index: int, mode: str, pull: bool) -> dict:
+    if mode == "degraded":
+        return degraded_start(image, index, pull)
+    return full_start(image, index, network=(mode == "full"), pull=pull)
+
+
+def run_benchmark(image: str, count: int, concurrency: int, mode: str, pull: bool = False) -> dict:
+    sequential = [one_start(image, i, mode, pull) for i in range(count)]
+
+    with ProcessPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(one_start, image, count + i, mode, pull) for i in range(count)]
+        concurrent = [f.result() for f in futures]
+
+    skipped = [p for p in PHASES if not any(p in r for r in sequential)]
+    return {
+        "image": image,
+        "mode": mode,
+        "runs": count,
+        "concurrency": concurrency,
+        "host": {"kernel": platform.release(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "timestamp": time.time(),
+        "skipped_phases": skipped,
+        "sequential": summarize(sequential),
+        "concurrent": summarize(concurrent),
+    }
+
+
+def print_report(result: dict):
+    print(f"mode={result['mode']} runs={result['runs']} concurrency={result['concurrency']}", file=sys.stderr)
+    for label in ("sequential", "concurrent"):
+        print(f"\n{label}:", file=sys.stderr)
+        for phase, stats in result[label].items():
+            print(f"  {phase:28} p50={stats['p50_ms']:8.2f}ms  p95={stats['p95_ms']:8.2f}ms  p99={stats['p99_ms']:8.2f}ms",
+                  file=sys.stderr)
+    if result["skipped_phases"]:
+        print(f"\nskipped: {', '.join(result['skipped_phases'])}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Container start latency benchmark")
+    parser.add_argument("image", help="A locally pulled image, e.g. alpine:latest")
+    parser.add_argument("-n", "--runs", type=int, default=20)
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("-o", "--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--pull", action="store_true", help="Include a docker_pull in every start")
+    parser.add_argument("--degraded", action="store_true", help="Force the unprivileged mode")
+    args = parser.parse_args(argv)
+
+    mode = "degraded" if args.degraded else detect_mode()
+    result = run_benchmark(args.image, args.runs, args.concurrency, mode, args.pull)
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
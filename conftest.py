@@ -0,0 +1 @@
+# Lets `pytest` import the `app` and `benchmarks` packages from the repo root.
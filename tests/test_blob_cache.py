@@ -0,0 +1,84 @@
+import hashlib
+import http.client
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from app.blob_cache import BlobCache
+from app.local_registry import LocalRegistry
+
+BLOB = bytes(range(256)) * 64
+DIGEST = "sha256:" + hashlib.sha256(BLOB).hexdigest()
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    blobs = tmp_path/"upstream"/"library"/"alpine"/"blobs"
+    blobs.mkdir(parents=True)
+    (blobs/DIGEST).write_bytes(BLOB)
+    server = serve(LocalRegistry(tmp_path/"upstream", latency=0.3))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_cache(tmp_path, upstream):
+    caches = []
+    def make(**kwargs):
+        cache = serve(BlobCache("127.0.0.1", 0, upstream.url, tmp_path/"blobs", tmp_path/"images", **kwargs))
+        caches.append(cache)
+        return cache
+    yield make
+    for cache in caches:
+        cache.shutdown()
+        cache.server_close()
+
+
+def get(cache, path, headers=None):
+    conn = http.client.HTTPConnection(*cache.server_address, timeout=10)
+    conn.request("GET", path, headers=headers or {})
+    rsp = conn.getresponse()
+    body = rsp.read()
+    conn.close()
+    return rsp.status, body
+
+
+def test_concurrent_misses_share_one_upstream_fetch(make_cache):
+    cache = make_cache()
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: get(cache, f"/v2/library/alpine/blobs/{DIGEST}"), range(8)))
+    assert results == [(200, BLOB)] * 8
+    assert cache.upstream_fetches == 1
+
+
+def test_range_requests(make_cache):
+    cache = make_cache()
+    assert get(cache, f"/v2/library/alpine/blobs/{DIGEST}", {"Range": "bytes=100-199"}) == (206, BLOB[100:200])
+    assert get(cache, f"/v2/library/alpine/blobs/{DIGEST}", {"Range": "bytes=-10"}) == (206, BLOB[-10:])
+    status, _ = get(cache, f"/v2/library/alpine/blobs/{DIGEST}", {"Range": f"bytes={len(BLOB)}-"})
+    assert status == 416
+
+
+def test_waiting_too_long_for_a_fetch_is_a_504(make_cache):
+    cache = make_cache(wait_timeout=0.05)
+    path = f"/v2/library/alpine/blobs/{DIGEST}"
+    leader = threading.Thread(target=get, args=(cache, path))
+    leader.start()
+    while not cache._inflight:
+        time.sleep(0.01)
+    assert get(cache, path)[0] == 504
+    leader.join()
+    assert get(cache, path) == (200, BLOB)
+
+
+@pytest.mark.parametrize("repo", ["..", "library/../../etc", "library//alpine", "Library/alpine"])
+def test_invalid_repositories_are_not_fetched(make_cache, repo):
+    cache = make_cache()
+    assert get(cache, f"/v2/{repo}/manifests/latest")[0] == 404
+    assert cache.upstream_fetches == 0
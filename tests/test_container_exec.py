@@ -0,0 +1,17 @@
+import os
+import pytest
+from app import state
+from app.container_exec import ContainerHandle
+
+
+def test_reused_pid_is_not_running():
+    recorded = state.process_start_time(os.getpid()) - 1
+    with pytest.raises(ProcessLookupError):
+        ContainerHandle("stale", os.getpid(), start_time=recorded)
+    assert not state.is_running({"pid": os.getpid(), "pid_start_time": recorded})
+
+
+def test_refuses_a_process_in_our_own_namespaces():
+    # What a stale state file pointing at a host process looks like.
+    with pytest.raises(PermissionError):
+        ContainerHandle("host", os.getpid(), start_time=state.process_start_time(os.getpid()))
@@ -0,0 +1,67 @@
+import os
+import time
+import threading
+import pytest
+from app import configs, container_logs
+from app.container_logs import ContainerLogger, LogRingBuffer, tail_log
+
+
+@pytest.fixture(autouse=True)
+def log_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(configs, "CONTAINER_LOG_PATH", str(tmp_path/"logs"))
+
+
+def write_container_output(container_id: str, lines: list, max_bytes: int, max_files: int = 3):
+    logger = ContainerLogger(container_id, max_bytes=max_bytes, max_files=max_files, chunk_size=64)
+    for line in lines:
+        os.write(logger.stdout_w, line)
+    logger.close_child_ends()
+    logger.pump()
+    return logger
+
+
+def test_ring_buffer_keeps_last_lines():
+    ring = LogRingBuffer(16)
+    ring.write(b"one\ntwo\nthree\nfour\n")
+    assert ring.lines(2) == [b"three\n", b"four\n"]
+    assert len(ring.getvalue()) == 16
+
+
+def test_rotation_and_tail_across_files():
+    lines = [f"line {i:03d}\n".encode() for i in range(50)]
+    logger = write_container_output("c1", lines, max_bytes=100)
+    rotated = sorted(p.name for p in logger.log_dir.glob("container.log.*"))
+    assert rotated == ["container.log.1", "container.log.2"]
+    assert tail_log("c1", 3) == lines[-3:]
+
+
+def test_logs_follow_prints_rotated_history(capfd):
+    lines = [f"line {i:03d}\n".encode() for i in range(20)]
+    write_container_output("c2", lines, max_bytes=100, max_files=10)
+    container_logs.main(["-f", "c2"])
+    assert capfd.readouterr().out.encode() == b"".join(lines)
+
+
+def test_logs_tail_without_value_is_a_usage_error():
+    write_container_output("c3", [b"x\n"], max_bytes=100)
+    with pytest.raises(SystemExit) as exc:
+        container_logs.main(["c3", "--tail"])
+    assert exc.value.code == 2
+
+
+def test_follow_catches_up_on_several_rotations_between_polls(tmp_path):
+    logger = ContainerLogger("c4", max_bytes=30, max_files=10, chunk_size=64)
+    out_path = tmp_path/"out"
+    out_fd = os.open(out_path, os.O_WRONLY | os.O_CREAT)
+    follower = threading.Thread(target=container_logs.follow_log, args=("c4", out_fd, 0, 0.5))
+    follower.start()
+    time.sleep(0.1) # the follower has the empty log open and is polling
+    lines = [f"line {i:03d}\n".encode() for i in range(20)]
+    for line in lines:
+        os.write(logger.stdout_w, line)
+    logger.close_child_ends()
+    logger.pump()
+    assert len(list(logger.log_dir.glob("container.log.*"))) > 2
+    follower.join(5)
+    os.close(out_fd)
+    assert out_path.read_bytes() == b"".join(lines)
@@ -0,0 +1,74 @@
+import io
+import os
+import tarfile
+from app import dedup
+
+BIG = b"shared content " * 512
+
+
+def make_layer(path):
+    with tarfile.open(path, "w:gz") as tar:
+        def add(name, data=b"", **attrs):
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            member.mode = 0o644
+            for key, value in attrs.items():
+                setattr(member, key, value)
+            tar.addfile(member, io.BytesIO(data))
+        add("usr", type=tarfile.DIRTYPE, mode=0o755)
+        add("usr/lib.so", BIG)
+        add("usr/lib.so.1", type=tarfile.LNKTYPE, linkname="usr/lib.so")
+        add("usr/small", b"tiny")
+    return path
+
+
+def test_extracting_again_leaves_store_objects_alone(tmp_path):
+    layer = make_layer(tmp_path/"layer.tar.gz")
+    store = dedup.ContentStore(tmp_path/"store", "hardlink")
+    dedup.extract_layer(layer, tmp_path/"a", store)
+    (obj,) = store.objects.glob("*/*")
+    inode = obj.stat().st_ino
+
+    stats = dedup.extract_layer(layer, tmp_path/"a", store)
+    dedup.extract_layer(layer, tmp_path/"b", store)
+
+    assert stats["deduped"] == 1
+    assert obj.read_bytes() == BIG
+    assert obj.stat().st_ino == inode
+    for layer_dir in ("a", "b"):
+        for name in ("usr/lib.so", "usr/lib.so.1"):
+            assert os.stat(tmp_path/layer_dir/name).st_ino == inode
+        assert (tmp_path/layer_dir/"usr/small").read_bytes() == b"tiny"
+
+
+def test_existing_file_is_replaced_not_written_through(tmp_path):
+    layer = make_layer(tmp_path/"layer.tar.gz")
+    store = dedup.ContentStore(tmp_path/"store", "hardlink")
+    dedup.extract_layer(layer, tmp_path/"a", store)
+    (obj,) = store.objects.glob("*/*")
+    # A small file at a path later extracted as-is, hardlinked to the store.
+    (tmp_path/"a/usr/small").unlink()
+    os.link(obj, tmp_path/"a/usr/small")
+
+    dedup.extract_layer(layer, tmp_path/"a", store)
+
+    assert obj.read_bytes() == BIG
+    assert (tmp_path/"a/usr/small").read_bytes() == b"tiny"
+
+
+def test_pull_skips_layers_already_extracted(tmp_path, monkeypatch):
+    from app import configs, pull
+    monkeypatch.setattr(configs, "EXTRACTED_LAYERS_PATH", str(tmp_path))
+    monkeypatch.setattr(configs, "LAYER_DEDUP", "hardlink")
+    monkeypatch.setattr(configs, "CONTENT_STORE_PATH", str(tmp_path/"store"))
+    layer = make_layer(tmp_path/"layer.tar.gz")
+    fetches = []
+    monkeypatch.setattr(pull, "fetch_blob", lambda *args: fetches.append(args) or layer)
+
+    stats = []
+    first = pull.fetch_layer(None, {"digest": "sha256:abc"}, dedup_stats=stats)
+    again = pull.fetch_layer(None, {"digest": "sha256:abc"}, dedup_stats=stats)
+
+    assert first == again and (first/"usr/lib.so").read_bytes() == BIG
+    assert len(fetches) == 1
+    assert dedup.summarize(stats) == {"files": 1, "deduped": 0, "bytes": len(BIG), "bytes_saved": 0}
@@ -0,0 +1,8 @@
+from benchmarks.import_time import FORBIDDEN, LAUNCH_PATH, measure
+
+
+def test_launch_path_leaves_the_pull_and_network_stacks_alone():
+    # The timing budget is machine dependent, `python3 -m benchmarks.import_time` checks it.
+    _, imported = measure(LAUNCH_PATH, runs=1)
+    leaked = sorted({m.split(".")[0] for m in imported} & set(FORBIDDEN))
+    assert not leaked, f"the run launch path imports {', '.join(leaked)}"
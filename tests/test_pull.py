@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import pytest
+import requests
+from app import configs, pull
+from app.blob_cache import BlobCache
+from app.local_registry import LocalRegistry, generate_image
+
+IMAGE = "bench:latest"
+
+
+@pytest.fixture
+def node(tmp_path, monkeypatch):
+    """A node with empty blob, layer and image dirs."""
+    for name, sub in [("LOCAL_IMAGE_REGISTRY", "images"), ("EXTRACTED_LAYERS_PATH", "layers"),
+                      ("LAYER_BLOB_PATH", "blobs")]:
+        monkeypatch.setattr(configs, name, str(tmp_path/"node"/sub))
+    monkeypatch.setattr(configs, "SESSION_DATA_PATH", str(tmp_path/"session.json"))
+    monkeypatch.setattr(configs, "LAYER_DEDUP", "off")
+    monkeypatch.setattr(configs, "PEER_MIRRORS", [])
+    return tmp_path/"node"
+
+
+def diff_ids(image_name: str) -> list:
+    config_path = Path(configs.LOCAL_IMAGE_REGISTRY)/image_name/"manifests"/"config_manifest.json"
+    return [diff_id.split(":")[-1] for diff_id in json.loads(config_path.read_text())["rootfs"]["diff_ids"]]
+
+
+@pytest.mark.parametrize("compression", ["gzip", "none"])
+def test_pull_from_local_registry_with_token_auth(tmp_path, node, monkeypatch, compression):
+    generate_image(tmp_path/"registry", IMAGE, layers=3, layer_size=64 * 1024, compression=compression)
+    registry = LocalRegistry(tmp_path/"registry", require_auth=True).start()
+    # Read when docker_pull runs, not when app.pull was imported.
+    monkeypatch.setattr(configs, "PULL_CONCURRENCY", 2)
+    workers = []
+    monkeypatch.setattr(pull, "ThreadPoolExecutor",
+                        lambda max_workers: workers.append(max_workers) or ThreadPoolExecutor(max_workers))
+    try:
+        pull.docker_pull(IMAGE, configs.LOCAL_IMAGE_REGISTRY, registry=registry.url)
+    finally:
+        registry.stop()
+
+    assert workers == [2]
+    session = json.loads((tmp_path/"session.json").read_text())
+    assert session[registry.url]["token"] in registry.tokens
+    layers = diff_ids("bench")
+    assert len(layers) == 3
+    for i, layer in enumerate(layers):
+        assert (node/"layers"/layer/f"layer{i}"/"data.txt").stat().st_size == 64 * 1024
+
+
+class FakeResponse:
+    """Serves `data` from `start`, failing with ConnectionError after `fail_after` bytes."""
+    def __init__(self, data: bytes, start: int = 0, fail_after: int = None, before_body=None):
+        self.status_code = 206 if start else 200
+        self.data = data[start:]
+        self.fail_after = fail_after
+        self.before_body = before_body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        if self.before_body:
+            self.before_body()
+        end = len(self.data) if self.fail_after is None else self.fail_after
+        for i in range(0, end, chunk_size):
+            yield self.data[i:min(i + chunk_size, end)]
+        if self.fail_after is not None:
+            raise requests.ConnectionError("connection reset")
+
+
+def test_puller_resumes_what_a_failed_puller_left_behind(tmp_path, monkeypatch):
+    blob = os.urandom(3 * 1024 * 1024)
+    digest = "sha256:" + hashlib.sha256(blob).hexdigest()
+    b_waiting = threading.Event()
+
+    def fake_get(url, headers=None, **kwargs):
+        start = int(headers["Range"][len("bytes="):-1]) if "Range" in headers else 0
+        if url == "a":
+            # A writes part of the blob only once B has opened the partial and waits for the lock.
+            return FakeResponse(blob, start, fail_after=1024 * 1024, before_body=lambda: b_waiting.wait(5))
+        return FakeResponse(blob, start)
+    monkeypatch.setattr(pull.requests, "get", fake_get)
+    def tracking_open(path, *args):
+        f = open(path, *args)
+        if threading.current_thread().name == "b" and str(path).endswith(".partial"):
+            b_waiting.set()
+        return f
+    monkeypatch.setattr(pull, "open", tracking_open, raising=False)
+
+    errors = []
+    def download(url):
+        try:
+            pull.download_layer(url, digest, {}, tmp_path)
+        except requests.ConnectionError as e:
+            errors.append(e)
+    a = threading.Thread(target=download, args=("a",), name="a")
+    a.start()
+    while not (tmp_path/f"{digest}.partial").exists():
+        time.sleep(0.01)
+    b = threading.Thread(target=download, args=("b",), name="b")
+    b.start()
+    a.join(5)
+    b.join(5)
+
+    assert len(errors) == 1
+    assert (tmp_path/digest).read_bytes() == blob
+    assert not (tmp_path/f"{digest}.partial").exists()
+
+
+class CountingRegistry(LocalRegistry):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = Counter()
+
+    def lookup(self, repo, kind, ref, headers=None):
+        self.requests[kind, ref] += 1
+        return super().lookup(repo, kind, ref, headers)
+
+
+def test_two_nodes_behind_one_blob_cache_fetch_each_digest_once(tmp_path, node, monkeypatch):
+    generate_image(tmp_path/"registry", "bench:v1", layers=3, layer_size=64 * 1024)
+    # Slower than the mirror's connect timeout: waiting on the cache must not count as unresponsive.
+    registry = CountingRegistry(tmp_path/"registry", latency=0.5).start()
+    cache = BlobCache("127.0.0.1", 0, registry.url, tmp_path/"cache"/"blobs", tmp_path/"cache"/"images").start()
+    monkeypatch.setattr(configs, "MIRROR_TIMEOUT", 0.2)
+    try:
+        for name in ("node1", "node2"):
+            for setting, sub in [("LOCAL_IMAGE_REGISTRY", "images"), ("EXTRACTED_LAYERS_PATH", "layers"),
+                                 ("LAYER_BLOB_PATH", "blobs")]:
+                monkeypatch.setattr(configs, setting, str(tmp_path/name/sub))
+            pull.docker_pull("bench:v1", configs.LOCAL_IMAGE_REGISTRY, registry=registry.url, mirrors=[cache.url])
+            assert len(diff_ids("bench")) == 3
+    finally:
+        cache.stop()
+        registry.stop()
+
+    # The tag (which resolves to the index), the image manifest, its config and 3 layers.
+    fetched = {key: count for key, count in registry.requests.items() if key != ("manifests", "latest")}
+    assert len(fetched) == 6 and set(fetched.values()) == {1}
@@ -0,0 +1,22 @@
+import pytest
+from benchmarks.start_latency import percentile, summarize
+
+
+@pytest.mark.parametrize("pct, n, expected", [
+    (95, 20, 19), # 19th of 20, not the max
+    (50, 2, 1),
+    (50, 22, 11),
+    (99, 20, 20),
+    (100, 20, 20),
+    (1, 20, 1),
+    (0, 5, 1),
+])
+def test_percentile_is_nearest_rank(pct, n, expected):
+    assert percentile(list(range(n, 0, -1)), pct) == expected
+
+
+def test_summarize_skips_missing_phases():
+    summary = summarize([{"fork_unshare": 0.001, "total": 0.01}, {"total": 0.02}])
+    assert set(summary) == {"fork_unshare", "total"}
+    assert summary["total"]["count"] == 2
+    assert summary["total"]["p50_ms"] == pytest.approx(10)
@@ -0,0 +1,101 @@
+import json
+import os
+import pytest
+from app import configs, state, storage
+from app.main import parse_run_options
+from app.storage import Volume, parse_size
+
+MiB = 1024**2
+
+
+@pytest.fixture(autouse=True)
+def paths(tmp_path, monkeypatch):
+    monkeypatch.setattr(configs, "VOLUMES_PATH", str(tmp_path/"volumes"))
+    monkeypatch.setattr(configs, "CONTAINER_STATE_PATH", str(tmp_path/"containers"))
+
+
+@pytest.mark.parametrize("size, expected", [("4096", 4096), ("64MB", 64 * MiB), ("64m", 64 * MiB), (512, 512)])
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+@pytest.mark.parametrize("size", ["", "MB", "12parsecs"])
+def test_parse_size_rejects(size):
+    with pytest.raises(ValueError):
+        parse_size(size)
+
+
+@pytest.mark.parametrize("spec, backend, size", [
+    ("data:/var/lib/data", "dir", None),
+    ("cache:/cache:tmpfs", "tmpfs", None),
+    ("cache:/cache:tmpfs=16MB", "tmpfs", 16 * MiB),
+    ("db:/db:file=1g", "file", 1024 * MiB),
+])
+def test_volume_specs(spec, backend, size):
+    volume = Volume.parse(spec)
+    assert (volume.backend, volume.size) == (backend, size)
+    assert volume.target.startswith("/") and volume.name == spec.split(":")[0]
+
+
+@pytest.mark.parametrize("spec", ["data", "data:relative", "data:/../etc", "../x:/x", "data:/x:nfs",
+                                  "db:/db:file", "a:/b:tmpfs:extra"])
+def test_invalid_volume_specs(spec):
+    with pytest.raises(ValueError):
+        Volume.parse(spec)
+
+
+def test_run_options():
+    network, options, rest = parse_run_options(["--no-network", "--storage", "tmpfs=32MB", "-v", "data:/data",
+                                                "--tmpfs", "/scratch", "alpine:latest", "sh", "-c", "ls"])
+    assert not network and rest == ["alpine:latest", "sh", "-c", "ls"]
+    assert (options.rootfs, options.rootfs_size) == ("tmpfs", 32 * MiB)
+    assert [v.name for v in options.volumes] == ["data"]
+    assert options.scratch == [("/scratch", parse_size(configs.TMPFS_SCRATCH_SIZE))]
+    assert options.needs_mounts
+
+
+def test_rm_refuses_volumes_of_running_containers(capsys):
+    volume = Volume("data", "/data")
+    volume.root.mkdir(parents=True)
+    (volume.root/"volume.json").write_text(json.dumps(volume._metadata()))
+    state.register_container("alpine_latest-12345", os.getpid(), "alpine:latest", volumes=["data"])
+
+    with pytest.raises(SystemExit):
+        storage.main(["rm", "data"])
+    assert "in use by alpine_latest-12345" in capsys.readouterr().err
+    assert volume.root.exists()
+
+    storage.main(["rm", "--force", "data"])
+    assert not volume.root.exists()
+
+
+def test_rm_ignores_containers_that_are_gone():
+    volume = Volume("data", "/data")
+    volume.root.mkdir(parents=True)
+    state.register_container("alpine_latest-12345", os.getpid(), "alpine:latest", volumes=["data"])
+    info = state.load_container("alpine_latest-12345")
+    info["pid_start_time"] -= 1
+    (volume.root.parent.parent/"containers"/"alpine_latest-12345.json").write_text(json.dumps(info))
+
+    volume.remove()
+    assert not volume.root.exists()
+
+
+def test_tmpfs_rootfs_must_fit_in_the_memory_limit():
+    assert parse_size(configs.TMPFS_ROOTFS_SIZE) < parse_size(configs.CONTAINER_MEMORY_LIMIT)
+    with pytest.raises(ValueError):
+        parse_run_options(["--storage", f"tmpfs={configs.CONTAINER_MEMORY_LIMIT}", "alpine:latest", "sh"])
+
+
+def test_mount_targets_resolve_symlinks_inside_the_container_root(tmp_path):
+    root = tmp_path/"root"
+    (root/"run").mkdir(parents=True)
+    (root/"var").mkdir()
+    (root/"var/run").symlink_to("/run")
+    (root/"var/up").symlink_to("../../../..")
+    assert storage._inside_root(root, "/var/run/x") == root/"run/x"
+    assert (root/"run/x").is_dir()
+    assert storage._inside_root(root, "/var/up/etc/cache") == root/"etc/cache"
+    (root/"loop").symlink_to("/loop")
+    with pytest.raises(ValueError):
+        storage._inside_root(root, "/loop/x")
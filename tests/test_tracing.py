@@ -0,0 +1,48 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from app import tracing
+
+
+@pytest.fixture
+def trace_file(tmp_path):
+    path = tmp_path/"run.trace"
+    tracing.enable(str(path))
+    yield path
+    tracing.disable()
+
+
+def spans(path) -> dict:
+    events = [json.loads(line) for line in path.read_text().splitlines()]
+    return {e["attrs"].get("n", e["name"]): e for e in events if e["type"] == "span"}
+
+
+def test_worker_spans_nest_under_the_submitting_span(trace_file):
+    def work(n):
+        with tracing.span("pull.download_layer", n=n):
+            pass
+
+    with tracing.span("pull.docker_pull"):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            list(pool.map(tracing.with_current_span(work), range(4)))
+    tracing.flush()
+
+    recorded = spans(trace_file)
+    root = recorded["pull.docker_pull"]
+    assert root["parent_id"] is None
+    for n in range(4):
+        assert recorded[n]["parent_id"] == root["id"]
+
+
+def test_repeated_spans_get_distinct_ids(trace_file):
+    with tracing.span("outer", n="a"):
+        with tracing.span("inner", n="b"):
+            pass
+    with tracing.span("outer", n="c"):
+        pass
+    tracing.flush()
+
+    recorded = spans(trace_file)
+    assert recorded["a"]["id"] != recorded["c"]["id"]
+    assert recorded["b"]["parent_id"] == recorded["a"]["id"]
+    assert recorded["c"]["parent_id"] is None